@@ -1,53 +1,318 @@
-from flask import Flask, render_template, request
-import jsonify
-import requests
-import pickle
-import numpy as np
-import sklearn
-from sklearn.preprocessing import StandardScaler
+from flask import Flask, Response, g, render_template, request, jsonify
+import comparables
+import fastjson
+import metrics
+import predictor
+import profiling
+import settings
+import shadow
 app = Flask(__name__)
-model = pickle.load(open('random_forest_regression_model.pkl', 'rb'))
+
+# endpoints that work before the first model has loaded
+SERVED_WHILE_LOADING = ('Home', 'ready', 'metrics_page', 'static')
+
+
+@app.before_request
+def pin_model():
+    # every stage of a request uses the model that was current when it arrived
+    predictor.ensure_watcher()
+    g.model = predictor.current
+    if g.model is None and request.endpoint not in SERVED_WHILE_LOADING and not request.path.startswith('/admin/'):
+        response = jsonify(error="model is loading")
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    forced = request.headers.get('X-Profile') == '1' and _is_admin()
+    if profiling.profiler.should_profile(forced):
+        g.profile = profiling.profiler.start()
+
+
+@app.after_request
+def model_version_header(response):
+    if g.get('model') is not None:
+        response.headers['X-Model-Version'] = g.model.version
+    return response
+
+
+@app.after_request
+def mirror_to_shadow(response):
+    if 'shadow' in g:
+        route, listings, prediction = g.pop('shadow')
+        loaded = g.model
+        # queued only once the response has been sent to the client
+        response.call_on_close(lambda: shadow.submit(route, listings, prediction, loaded))
+    return response
+
+
+def _shadow(route, listings, prediction):
+    if shadow.evaluator is not None:
+        g.shadow = (route, listings, prediction)
+
+
+@app.teardown_request
+def stop_profile(exc):
+    if 'profile' in g:
+        profiling.profiler.stop(g.pop('profile'))
+
+
 @app.route('/',methods=['GET'])
 def Home():
     return render_template('index.html')
 
 
-standard_to = StandardScaler()
+
 @app.route("/predict", methods=['POST'])
 def predict():
-    Fuel_Type_Diesel=0
     if request.method == 'POST':
-        Year = int(request.form['Year'])
-        Present_Price=float(request.form['Present_Price'])
-        Kms_Driven=int(request.form['Kms_Driven'])
-        Kms_Driven2=np.log(Kms_Driven)
-        Owner=int(request.form['Owner'])
-        Fuel_Type_Petrol=request.form['Fuel_Type_Petrol']
-        if(Fuel_Type_Petrol=='Petrol'):
-                Fuel_Type_Petrol=1
-                Fuel_Type_Diesel=0
-        else:
-            Fuel_Type_Petrol=0
-            Fuel_Type_Diesel=1
-        Year=2020-Year
-        Seller_Type_Individual=request.form['Seller_Type_Individual']
-        if(Seller_Type_Individual=='Individual'):
-            Seller_Type_Individual=1
-        else:
-            Seller_Type_Individual=0	
-        Transmission_Mannual=request.form['Transmission_Mannual']
-        if(Transmission_Mannual=='Mannual'):
-            Transmission_Mannual=1
+        stages = metrics.Stages('predict')
+        form = request.form.to_dict()
+        stages.mark('parse')
+        try:
+            X = predictor.encode(form, g.model)
+        except ValueError as e:
+            metrics.REQUESTS.labels('predict', 'invalid').inc()
+            return render_template('index.html', prediction_text=str(e)), 400
+        stages.mark('encode')
+        if settings.FORM_PRICE_RANGE:
+            prediction, spread = predictor.score_range(X, settings.PRICE_QUANTILES, g.model)
         else:
-            Transmission_Mannual=0
-        prediction=model.predict([[Present_Price,Kms_Driven2,Owner,Year,Fuel_Type_Diesel,Fuel_Type_Petrol,Seller_Type_Individual,Transmission_Mannual]])
+            prediction=predictor.score(X, g.model)
+        stages.mark('predict')
+        _shadow('predict', form, prediction)
         output=round(prediction[0],2)
         if output<0:
-            return render_template('index.html',prediction_texts="Sorry you cannot sell this car")
+            outcome = 'cannot_sell'
+            page = render_template('index.html',prediction_texts="Sorry you cannot sell this car")
         else:
-            return render_template('index.html',prediction_text="You Can Sell The Car at {}".format(output))
+            outcome = 'ok'
+            text = "You Can Sell The Car at {}".format(output)
+            if settings.FORM_PRICE_RANGE:
+                text += " (likely between {} and {})".format(round(spread.min(), 2), round(spread.max(), 2))
+            page = render_template('index.html',prediction_text=text)
+        stages.mark('render')
+        metrics.REQUESTS.labels('predict', outcome).inc()
+        return page
     else:
         return render_template('index.html')
 
+
+@app.route("/predict/batch", methods=['POST'])
+def predict_batch():
+    stages = metrics.Stages('predict_batch')
+    try:
+        listings = predictor.listings_from_payload(request.get_json(silent=True))
+        quantiles = predictor.requested_quantiles(request.args.get('range'))
+        stages.mark('parse')
+        X = predictor.encode(listings, g.model)
+    except ValueError as e:
+        metrics.REQUESTS.labels('predict_batch', 'invalid').inc()
+        return jsonify(error=str(e)), 400
+    stages.mark('encode')
+    metrics.BATCH_SIZE.labels('request').observe(len(X))
+    spread = None
+    if quantiles:
+        prediction, spread = predictor.score_range(X, quantiles, g.model)
+    else:
+        prediction = predictor.score(X, g.model)
+    stages.mark('predict')
+    _shadow('predict_batch', listings, prediction)
+    response = jsonify(predictor.batch_result(prediction, g.model, quantiles, spread))
+    stages.mark('render')
+    metrics.REQUESTS.labels('predict_batch', 'ok').inc()
+    return response
+
+
+@app.route("/api/v1/predict", methods=['GET', 'POST'])
+def api_predict():
+    stages = metrics.Stages('api_predict')
+    try:
+        if request.method == 'POST' and request.mimetype == 'application/json':
+            listing = predictor.listing_from_payload(fastjson.loads(request.get_data()))
+        else:
+            listing = request.values.to_dict()
+        quantiles = predictor.requested_quantiles(request.args.get('range'))
+        k = comparables.requested_k(request.args.get('comparables'))
+        stages.mark('parse')
+        X = predictor.encode(listing, g.model)
+    except ValueError as e:
+        metrics.REQUESTS.labels('api_predict', 'invalid').inc()
+        return Response(fastjson.dumps({'error': str(e)}), status=400, content_type=fastjson.CONTENT_TYPE)
+    stages.mark('encode')
+    if quantiles:
+        prediction, spread = predictor.score_range(X, quantiles, g.model)
+        result = predictor.api_result(prediction, g.model, quantiles, spread)
+    else:
+        prediction = predictor.score(X, g.model)
+        result = predictor.api_result(prediction, g.model)
+    stages.mark('predict')
+    _shadow('api_predict', listing, prediction)
+    if k:
+        try:
+            result['comparables'] = comparables.get_index().query(listing, k)[0]
+        except ValueError as e:
+            metrics.REQUESTS.labels('api_predict', 'invalid').inc()
+            return Response(fastjson.dumps({'error': str(e)}), status=400, content_type=fastjson.CONTENT_TYPE)
+        except RuntimeError as e:
+            metrics.REQUESTS.labels('api_predict', 'unavailable').inc()
+            return Response(fastjson.dumps({'error': str(e)}), status=503, content_type=fastjson.CONTENT_TYPE)
+        stages.mark('comparables')
+    response = Response(fastjson.dumps(result), content_type=fastjson.CONTENT_TYPE)
+    stages.mark('render')
+    metrics.REQUESTS.labels('api_predict', 'ok' if result['can_sell'] else 'cannot_sell').inc()
+    return response
+
+
+@app.route("/explain", methods=['POST'])
+def explain():
+    stages = metrics.Stages('explain')
+    try:
+        listings, single = predictor.explain_payload(request.get_json(silent=True))
+        stages.mark('parse')
+        X = predictor.encode(listings, g.model)
+        stages.mark('encode')
+        contributions = predictor.explain(X, g.model)
+    except ValueError as e:
+        metrics.REQUESTS.labels('explain', 'invalid').inc()
+        return Response(fastjson.dumps({'error': str(e)}), status=400, content_type=fastjson.CONTENT_TYPE)
+    stages.mark('predict')
+    response = Response(fastjson.dumps(predictor.explain_result(contributions, g.model, single)),
+                        content_type=fastjson.CONTENT_TYPE)
+    stages.mark('render')
+    metrics.REQUESTS.labels('explain', 'ok').inc()
+    return response
+
+
+@app.route("/ready", methods=['GET'])
+def ready():
+    """Readiness probe: 200 once the first model is loaded and warmed up."""
+    status = predictor.readiness()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route("/api/v1/price-curve", methods=['POST'])
+def price_curve():
+    """Prices of a listing swept over one or two fields, scored in one model call."""
+    stages = metrics.Stages('price_curve')
+    try:
+        listing, sweeps = predictor.price_curve_payload(request.get_json(silent=True))
+        quantiles = predictor.requested_quantiles(request.args.get('range'))
+        stages.mark('parse')
+        X, axes = predictor.price_curve_grid(listing, sweeps, g.model)
+    except ValueError as e:
+        metrics.REQUESTS.labels('price_curve', 'invalid').inc()
+        return Response(fastjson.dumps({'error': str(e)}), status=400, content_type=fastjson.CONTENT_TYPE)
+    stages.mark('encode')
+    metrics.BATCH_SIZE.labels('price_curve').observe(len(X))
+    prediction, spread = predictor.score_grid(X, quantiles, g.model)
+    stages.mark('predict')
+    response = Response(fastjson.dumps(predictor.price_curve_result(prediction, axes, g.model, quantiles, spread)),
+                        content_type=fastjson.CONTENT_TYPE)
+    stages.mark('render')
+    metrics.REQUESTS.labels('price_curve', 'ok').inc()
+    return response
+
+
+@app.route("/comparables", methods=['POST'])
+def comparables_lookup():
+    """The ``k`` most similar listings of car data.csv, for one listing or a batch."""
+    stages = metrics.Stages('comparables')
+    try:
+        listings, single = predictor.explain_payload(request.get_json(silent=True))
+        k = comparables.requested_k(request.args.get('k'), settings.COMPARABLES_K)
+        stages.mark('parse')
+        results = comparables.get_index().query(listings, k)
+    except ValueError as e:
+        metrics.REQUESTS.labels('comparables', 'invalid').inc()
+        return Response(fastjson.dumps({'error': str(e)}), status=400, content_type=fastjson.CONTENT_TYPE)
+    except RuntimeError as e:
+        metrics.REQUESTS.labels('comparables', 'unavailable').inc()
+        return Response(fastjson.dumps({'error': str(e)}), status=503, content_type=fastjson.CONTENT_TYPE)
+    stages.mark('comparables')
+    response = Response(fastjson.dumps({'comparables': results[0]} if single else {'results': results}),
+                        content_type=fastjson.CONTENT_TYPE)
+    stages.mark('render')
+    metrics.REQUESTS.labels('comparables', 'ok').inc()
+    return response
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_page():
+    predictor.refresh_metrics()
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def _is_admin():
+    return bool(settings.ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == settings.ADMIN_TOKEN
+
+
+def _admin_denied():
+    if not settings.ADMIN_TOKEN:
+        return jsonify(error="admin routes are disabled; set CAR_ADMIN_TOKEN"), 403
+    if not _is_admin():
+        return jsonify(error="invalid admin token"), 403
+    return None
+
+
+@app.route("/admin/model", methods=['GET'])
+def admin_model():
+    return _admin_denied() or jsonify(predictor.model_status())
+
+
+@app.route("/admin/reload", methods=['POST'])
+def admin_reload():
+    """Reload the model in this process only.
+
+    Under serve_prefork that is the one worker that received the request;
+    set CAR_RELOAD_INTERVAL so every worker's watcher picks up a new file.
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    try:
+        _, swapped = predictor.reload_model(force=request.args.get('force') == '1')
+    except Exception as e:
+        return jsonify(error="reload failed: {}".format(e), model=predictor.model_status()), 500
+    return jsonify(swapped=swapped, model=predictor.model_status())
+
+
+@app.route("/admin/drift", methods=['GET'])
+def admin_drift():
+    """Drift scores of the serving model's traffic; ?reset=1 clears the live histograms."""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    report = predictor.drift_report(g.model)
+    if request.args.get('reset') == '1' and g.model is not None and g.model.drift is not None:
+        g.model.drift.reset()
+    return jsonify(report)
+
+
+@app.route("/admin/shadow", methods=['GET'])
+def admin_shadow():
+    if shadow.evaluator is None:
+        return _admin_denied() or jsonify(enabled=False)
+    return _admin_denied() or jsonify(enabled=True, **shadow.evaluator.stats())
+
+
+@app.route("/admin/profile", methods=['GET', 'POST'])
+def admin_profile():
+    """GET: collapsed stacks (?reset=1 clears them); POST ?rate=: change the sampled fraction."""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        try:
+            if 'rate' in request.args:
+                profiling.profiler.rate = profiling.parse_rate(request.args['rate'])
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        if request.args.get('reset') == '1':
+            profiling.profiler.reset()
+        return jsonify(profiling.profiler.stats())
+    body = profiling.profiler.collapsed()
+    if request.args.get('reset') == '1':
+        profiling.profiler.reset()
+    return Response(body, content_type='text/plain; charset=utf-8')
+
 if __name__=="__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
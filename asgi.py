@@ -0,0 +1,414 @@
+"""ASGI entry point serving the same routes as app.py.
+
+Requests are read and parsed on the event loop; scoring runs on a bounded
+thread pool, where sklearn's tree traversal releases the GIL, so one
+process can hold many slow connections open and still use its cores.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+Runs under any ASGI server; it has no dependencies beyond the ones app.py
+already needs.
+"""
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import comparables
+import fastjson
+import metrics
+import predictor
+import profiling
+import settings
+import shadow
+
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+_templates = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+    autoescape=select_autoescape(['html']),
+)
+# paths that work before the first model has loaded
+SERVED_WHILE_LOADING = ('/', '/ready', '/metrics')
+_urls = {'Home': '/', 'predict': '/predict', 'predict_batch': '/predict/batch'}
+_templates.globals['url_for'] = lambda endpoint, **values: _urls[endpoint]
+
+_executor = ThreadPoolExecutor(max_workers=settings.ASGI_THREADS, thread_name_prefix='asgi-score')
+_slots = None
+# set for requests picked by the sampling profiler; only work offloaded to
+# the pool is sampled, as the event loop thread is shared by all requests
+_profiled = contextvars.ContextVar('profiled', default=False)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+async def _offload(fn, *args):
+    # the semaphore bounds queued work; the pool itself has an unbounded queue
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(settings.ASGI_MAX_PENDING)
+    if _profiled.get():
+        fn = profiling.profiler.wrap(fn)
+    async with _slots:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise HTTPError(400, "client disconnected")
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def _respond(send, status, body, content_type, model_version=None):
+    headers = [(b'content-type', content_type.encode('latin-1')),
+               (b'content-length', str(len(body)).encode('latin-1'))]
+    if model_version is not None:
+        headers.append((b'x-model-version', model_version.encode('latin-1')))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _render(**context):
+    return _templates.get_template('index.html').render(**context).encode('utf-8')
+
+
+async def home(scope, receive):
+    return 200, _render(), 'text/html; charset=utf-8'
+
+
+async def predict(scope, receive):
+    body = await _read_body(receive)
+    stages = metrics.Stages('predict')
+    form = {}
+    try:
+        for key, value in parse_qsl(body.decode('utf-8'), keep_blank_values=True):
+            form.setdefault(key, value)
+        stages.mark('parse')
+        X = predictor.encode(form, scope['model'])
+    except ValueError as e:
+        # UnicodeDecodeError included; the form page shows the error like app.py
+        metrics.REQUESTS.labels('predict', 'invalid').inc()
+        return 400, _render(prediction_text=str(e)), 'text/html; charset=utf-8'
+    stages.mark('encode')
+    if settings.FORM_PRICE_RANGE:
+        prediction, spread = await _offload(predictor.score_range, X, settings.PRICE_QUANTILES, scope['model'])
+    else:
+        prediction = await _offload(predictor.score, X, scope['model'])
+    stages.mark('predict')
+    scope['shadow'] = ('predict', form, prediction)
+    output = round(prediction[0], 2)
+    if output < 0:
+        outcome = 'cannot_sell'
+        page = _render(prediction_texts="Sorry you cannot sell this car")
+    else:
+        outcome = 'ok'
+        text = "You Can Sell The Car at {}".format(output)
+        if settings.FORM_PRICE_RANGE:
+            text += " (likely between {} and {})".format(round(spread.min(), 2), round(spread.max(), 2))
+        page = _render(prediction_text=text)
+    stages.mark('render')
+    metrics.REQUESTS.labels('predict', outcome).inc()
+    return 200, page, 'text/html; charset=utf-8'
+
+
+async def predict_batch(scope, receive):
+    body = await _read_body(receive)
+    stages = metrics.Stages('predict_batch')
+    try:
+        listings = predictor.listings_from_payload(fastjson.loads(body or b'null'))
+        quantiles = predictor.requested_quantiles(_query(scope, 'range'))
+        stages.mark('parse')
+        # large batches are encoded off the loop too
+        X = await _offload(predictor.encode, listings, scope['model'])
+    except ValueError as e:
+        metrics.REQUESTS.labels('predict_batch', 'invalid').inc()
+        raise HTTPError(400, str(e))
+    stages.mark('encode')
+    metrics.BATCH_SIZE.labels('request').observe(len(X))
+    spread = None
+    if quantiles:
+        prediction, spread = await _offload(predictor.score_range, X, quantiles, scope['model'])
+    else:
+        prediction = await _offload(predictor.score, X, scope['model'])
+    stages.mark('predict')
+    scope['shadow'] = ('predict_batch', listings, prediction)
+    body = fastjson.dumps(predictor.batch_result(prediction, scope['model'], quantiles, spread))
+    stages.mark('render')
+    metrics.REQUESTS.labels('predict_batch', 'ok').inc()
+    return 200, body, fastjson.CONTENT_TYPE
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def _query(scope, name):
+    for key, value in parse_qsl(scope.get('query_string', b'').decode('latin-1')):
+        if key == name:
+            return value
+    return None
+
+
+async def api_predict(scope, receive):
+    body = await _read_body(receive)
+    stages = metrics.Stages('api_predict')
+    try:
+        if body and _header(scope, b'content-type').split(';')[0].strip() == 'application/json':
+            listing = predictor.listing_from_payload(fastjson.loads(body))
+        else:
+            listing = {}
+            query = scope.get('query_string', b'').decode('latin-1')
+            for key, value in parse_qsl(query + '&' + body.decode('utf-8'), keep_blank_values=True):
+                listing.setdefault(key, value)
+        quantiles = predictor.requested_quantiles(_query(scope, 'range'))
+        k = comparables.requested_k(_query(scope, 'comparables'))
+        stages.mark('parse')
+        X = predictor.encode(listing, scope['model'])
+    except ValueError as e:
+        metrics.REQUESTS.labels('api_predict', 'invalid').inc()
+        raise HTTPError(400, str(e))
+    stages.mark('encode')
+    if quantiles:
+        prediction, spread = await _offload(predictor.score_range, X, quantiles, scope['model'])
+        result = predictor.api_result(prediction, scope['model'], quantiles, spread)
+    else:
+        prediction = await _offload(predictor.score, X, scope['model'])
+        result = predictor.api_result(prediction, scope['model'])
+    stages.mark('predict')
+    scope['shadow'] = ('api_predict', listing, prediction)
+    if k:
+        try:
+            # the first lookup may build the index, so it runs off the loop
+            index = await _offload(comparables.get_index)
+            result['comparables'] = (await _offload(index.query, listing, k))[0]
+        except ValueError as e:
+            metrics.REQUESTS.labels('api_predict', 'invalid').inc()
+            raise HTTPError(400, str(e))
+        except RuntimeError as e:
+            metrics.REQUESTS.labels('api_predict', 'unavailable').inc()
+            raise HTTPError(503, str(e))
+        stages.mark('comparables')
+    body = fastjson.dumps(result)
+    stages.mark('render')
+    metrics.REQUESTS.labels('api_predict', 'ok' if result['can_sell'] else 'cannot_sell').inc()
+    return 200, body, fastjson.CONTENT_TYPE
+
+
+async def explain(scope, receive):
+    body = await _read_body(receive)
+    stages = metrics.Stages('explain')
+    try:
+        listings, single = predictor.explain_payload(fastjson.loads(body or b'null'))
+        stages.mark('parse')
+        X = predictor.encode(listings, scope['model'])
+        stages.mark('encode')
+        contributions = await _offload(predictor.explain, X, scope['model'])
+    except ValueError as e:
+        metrics.REQUESTS.labels('explain', 'invalid').inc()
+        raise HTTPError(400, str(e))
+    stages.mark('predict')
+    body = fastjson.dumps(predictor.explain_result(contributions, scope['model'], single))
+    stages.mark('render')
+    metrics.REQUESTS.labels('explain', 'ok').inc()
+    return 200, body, fastjson.CONTENT_TYPE
+
+
+async def ready(scope, receive):
+    status = predictor.readiness()
+    return 200 if status['ready'] else 503, fastjson.dumps(status), fastjson.CONTENT_TYPE
+
+
+async def price_curve(scope, receive):
+    body = await _read_body(receive)
+    stages = metrics.Stages('price_curve')
+    try:
+        listing, sweeps = predictor.price_curve_payload(fastjson.loads(body or b'null'))
+        quantiles = predictor.requested_quantiles(_query(scope, 'range'))
+        stages.mark('parse')
+        X, axes = await _offload(predictor.price_curve_grid, listing, sweeps, scope['model'])
+    except ValueError as e:
+        metrics.REQUESTS.labels('price_curve', 'invalid').inc()
+        raise HTTPError(400, str(e))
+    stages.mark('encode')
+    metrics.BATCH_SIZE.labels('price_curve').observe(len(X))
+    prediction, spread = await _offload(predictor.score_grid, X, quantiles, scope['model'])
+    stages.mark('predict')
+    body = fastjson.dumps(predictor.price_curve_result(prediction, axes, scope['model'], quantiles, spread))
+    stages.mark('render')
+    metrics.REQUESTS.labels('price_curve', 'ok').inc()
+    return 200, body, fastjson.CONTENT_TYPE
+
+
+async def comparables_lookup(scope, receive):
+    body = await _read_body(receive)
+    stages = metrics.Stages('comparables')
+    try:
+        listings, single = predictor.explain_payload(fastjson.loads(body or b'null'))
+        k = comparables.requested_k(_query(scope, 'k'), settings.COMPARABLES_K)
+        stages.mark('parse')
+        # the first lookup may build the index, so it runs off the loop
+        index = await _offload(comparables.get_index)
+        results = await _offload(index.query, listings, k)
+    except ValueError as e:
+        metrics.REQUESTS.labels('comparables', 'invalid').inc()
+        raise HTTPError(400, str(e))
+    except RuntimeError as e:
+        metrics.REQUESTS.labels('comparables', 'unavailable').inc()
+        raise HTTPError(503, str(e))
+    stages.mark('comparables')
+    body = fastjson.dumps({'comparables': results[0]} if single else {'results': results})
+    stages.mark('render')
+    metrics.REQUESTS.labels('comparables', 'ok').inc()
+    return 200, body, fastjson.CONTENT_TYPE
+
+
+async def metrics_page(scope, receive):
+    predictor.refresh_metrics()
+    return 200, metrics.render().encode('utf-8'), metrics.CONTENT_TYPE
+
+
+def _is_admin(scope):
+    return bool(settings.ADMIN_TOKEN) and _header(scope, b'x-admin-token') == settings.ADMIN_TOKEN
+
+
+def _check_admin(scope):
+    if not settings.ADMIN_TOKEN:
+        raise HTTPError(403, "admin routes are disabled; set CAR_ADMIN_TOKEN")
+    if not _is_admin(scope):
+        raise HTTPError(403, "invalid admin token")
+
+
+async def admin_model(scope, receive):
+    _check_admin(scope)
+    return 200, fastjson.dumps(predictor.model_status()), fastjson.CONTENT_TYPE
+
+
+async def admin_reload(scope, receive):
+    # reloads this process only; other workers rely on their file watchers
+    _check_admin(scope)
+    force = _query(scope, 'force') == '1'
+    try:
+        # loading and warming up the new model stays off the event loop
+        _, swapped = await asyncio.get_running_loop().run_in_executor(None, predictor.reload_model, force)
+    except Exception as e:
+        raise HTTPError(500, "reload failed: {}".format(e))
+    return 200, fastjson.dumps({'swapped': swapped, 'model': predictor.model_status()}), fastjson.CONTENT_TYPE
+
+
+async def admin_drift(scope, receive):
+    _check_admin(scope)
+    report = predictor.drift_report(scope['model'])
+    if _query(scope, 'reset') == '1' and scope['model'] is not None and scope['model'].drift is not None:
+        scope['model'].drift.reset()
+    return 200, fastjson.dumps(report), fastjson.CONTENT_TYPE
+
+
+async def admin_shadow(scope, receive):
+    _check_admin(scope)
+    if shadow.evaluator is None:
+        return 200, fastjson.dumps({'enabled': False}), fastjson.CONTENT_TYPE
+    return 200, fastjson.dumps(dict(shadow.evaluator.stats(), enabled=True)), fastjson.CONTENT_TYPE
+
+
+async def admin_profile(scope, receive):
+    _check_admin(scope)
+    if scope['method'] == 'POST':
+        rate = _query(scope, 'rate')
+        try:
+            if rate is not None:
+                profiling.profiler.rate = profiling.parse_rate(rate)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        if _query(scope, 'reset') == '1':
+            profiling.profiler.reset()
+        return 200, fastjson.dumps(profiling.profiler.stats()), fastjson.CONTENT_TYPE
+    body = profiling.profiler.collapsed().encode('utf-8')
+    if _query(scope, 'reset') == '1':
+        profiling.profiler.reset()
+    return 200, body, 'text/plain; charset=utf-8'
+
+
+ROUTES = {
+    ('GET', '/'): home,
+    ('POST', '/predict'): predict,
+    ('POST', '/predict/batch'): predict_batch,
+    ('GET', '/api/v1/predict'): api_predict,
+    ('POST', '/api/v1/predict'): api_predict,
+    ('POST', '/api/v1/price-curve'): price_curve,
+    ('POST', '/explain'): explain,
+    ('POST', '/comparables'): comparables_lookup,
+    ('GET', '/ready'): ready,
+    ('GET', '/metrics'): metrics_page,
+    ('GET', '/admin/model'): admin_model,
+    ('POST', '/admin/reload'): admin_reload,
+    ('GET', '/admin/drift'): admin_drift,
+    ('GET', '/admin/shadow'): admin_shadow,
+    ('GET', '/admin/profile'): admin_profile,
+    ('POST', '/admin/profile'): admin_profile,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            predictor.ensure_watcher()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    handler = ROUTES.get((scope['method'], scope['path']))
+    # every stage of a request uses the model that was current when it arrived
+    predictor.ensure_watcher()
+    scope['model'] = predictor.current
+    forced = _header(scope, b'x-profile') == '1' and _is_admin(scope)
+    _profiled.set(profiling.profiler.should_profile(forced))
+    try:
+        if handler is None:
+            if any(path == scope['path'] for _, path in ROUTES):
+                raise HTTPError(405, "method not allowed")
+            raise HTTPError(404, "not found")
+        if scope['model'] is None and scope['path'] not in SERVED_WHILE_LOADING \
+                and not scope['path'].startswith('/admin/'):
+            raise HTTPError(503, "model is loading")
+        status, body, content_type = await handler(scope, receive)
+    except HTTPError as e:
+        status, body, content_type = e.status, fastjson.dumps({'error': str(e)}), fastjson.CONTENT_TYPE
+    await _respond(send, status, body, content_type,
+                   scope['model'].version if scope['model'] is not None else None)
+    if 'shadow' in scope:
+        # after the response, so the candidate never delays it
+        shadow.submit(*scope.pop('shadow'), scope['model'])
@@ -0,0 +1,275 @@
+"""Load test and latency benchmark for the prediction service.
+
+Drives app.py in-process through Flask's test client and over a local
+socket (a threaded werkzeug server on an ephemeral port), and times the raw
+model call, reporting throughput and p50/p95/p99 latency per scenario and
+concurrency level.  Results are written as JSON so model versions and
+serving modes (CAR_INFERENCE_ENGINE, CAR_COALESCE, artifacts, ...) can be
+compared between releases.  The prediction cache is emptied before every
+timed run, and each result records the cache hit ratio it saw.
+
+    python benchmark.py --concurrency 1,4,16 --requests 2000 --output bench.json
+"""
+import argparse
+import csv
+import http.client
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import numpy as np
+
+SCENARIOS = ('model', 'predict', 'api_predict', 'batch')
+TRANSPORTS = ('inprocess', 'socket')
+
+
+def load_listings(path='car data.csv'):
+    with open(path, newline='') as f:
+        return [dict((k, row[k]) for k in ('Year', 'Present_Price', 'Kms_Driven', 'Owner',
+                                            'Fuel_Type', 'Seller_Type', 'Transmission'))
+                for row in csv.DictReader(f)]
+
+
+def _form(listing):
+    return {
+        'Year': listing['Year'],
+        'Present_Price': listing['Present_Price'],
+        'Kms_Driven': listing['Kms_Driven'],
+        'Owner': listing['Owner'],
+        'Fuel_Type_Petrol': listing['Fuel_Type'],
+        'Seller_Type_Individual': listing['Seller_Type'],
+        'Transmission_Mannual': 'Mannual' if listing['Transmission'] == 'Manual' else 'Automatic',
+    }
+
+
+class InProcessClient(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, body, content_type):
+        response = self.client.post(path, data=body, content_type=content_type)
+        return response.status_code
+
+
+class SocketClient(object):
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def post(self, path, body, content_type):
+        self.conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+        response = self.conn.getresponse()
+        response.read()
+        return response.status
+
+
+def _request_factory(scenario, listings, batch_size, batch_requests=1):
+    """Return fn(client, i) -> status for one request of ``scenario``."""
+    if scenario == 'predict':
+        bodies = [urlencode(_form(listing)) for listing in listings]
+        return lambda client, i: client.post('/predict', bodies[i % len(bodies)],
+                                             'application/x-www-form-urlencoded')
+    if scenario == 'api_predict':
+        bodies = [json.dumps(listing) for listing in listings]
+        return lambda client, i: client.post('/api/v1/predict', bodies[i % len(bodies)],
+                                             'application/json')
+    if scenario == 'batch':
+        # every row of every request is a distinct listing, one km further
+        # on each pass through the data, so batches are not cache hits
+        bodies = []
+        for i in range(batch_requests):
+            rows = []
+            for j in range(i * batch_size, (i + 1) * batch_size):
+                listing = listings[j % len(listings)]
+                rows.append(dict(listing, Kms_Driven=int(listing['Kms_Driven']) + j // len(listings)))
+            bodies.append(json.dumps(rows))
+        return lambda client, i: client.post('/predict/batch', bodies[i % len(bodies)], 'application/json')
+    raise ValueError(scenario)
+
+
+def _model_call(model_predict, X):
+    def send(client, i):
+        row = i % len(X)
+        model_predict(X[row:row + 1])
+        return 200
+    return send
+
+
+def _percentiles(latencies):
+    p50, p95, p99 = (float(p) for p in np.percentile(latencies, [50, 95, 99]) * 1000)
+    return {'p50_ms': round(p50, 4), 'p95_ms': round(p95, 4), 'p99_ms': round(p99, 4),
+            'mean_ms': round(float(np.mean(latencies)) * 1000, 4)}
+
+
+def _drive(make_client, send, concurrency, total, warmup, before_timing=None):
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    warmed = threading.Barrier(concurrency + 1)
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(slot):
+        client = make_client()
+        for i in range(warmup):
+            send(client, i)
+        warmed.wait()
+        barrier.wait()
+        own = latencies[slot]
+        for i in range(slot, total, concurrency):
+            start = time.perf_counter()
+            try:
+                status = send(client, i)
+            except Exception:
+                status = None
+            own.append(time.perf_counter() - start)
+            if status != 200:
+                errors[slot] += 1
+
+    threads = [threading.Thread(target=worker, args=(slot,)) for slot in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    warmed.wait()
+    if before_timing is not None:
+        before_timing()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return np.concatenate([np.asarray(l) for l in latencies]), elapsed, sum(errors)
+
+
+class _CacheCounter(object):
+    """Empties the prediction cache before a timed run and reports its hit ratio."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._start = None
+
+    def reset(self):
+        if self.cache is not None:
+            self.cache.clear()
+            self._start = self.cache.stats()
+
+    def hit_ratio(self):
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        hits = stats['hits'] - self._start['hits']
+        lookups = hits + stats['misses'] - self._start['misses']
+        return round(hits / lookups, 4) if lookups else None
+
+
+def _start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def run(scenarios, transports, concurrency_levels, total, batch_size, batch_requests, warmup):
+    import app
+    import predictor
+
+    listings = load_listings()
+    server = _start_server(app.app) if 'socket' in transports else None
+    # every level starts cold, so listings repeated across levels are not free hits
+    counter = _CacheCounter(predictor.cache)
+    results = []
+    for scenario in scenarios:
+        rows = batch_size if scenario == 'batch' else 1
+        requests = batch_requests if scenario == 'batch' else total
+        if scenario == 'model':
+            X = predictor.current.encoder.transform(listings)
+            plan = [('direct', lambda: None, _model_call(predictor.model_predict, X))]
+        else:
+            send = _request_factory(scenario, listings, batch_size, batch_requests)
+            plan = []
+            if 'inprocess' in transports:
+                plan.append(('inprocess', lambda: InProcessClient(app.app), send))
+            if server is not None:
+                plan.append(('socket', lambda: SocketClient(server.port), send))
+        for transport, make_client, send in plan:
+            for concurrency in concurrency_levels:
+                latencies, elapsed, errors = _drive(make_client, send, concurrency, requests, warmup,
+                                                    counter.reset)
+                result = {
+                    'scenario': scenario,
+                    'transport': transport,
+                    'concurrency': concurrency,
+                    'requests': requests,
+                    'rows_per_request': rows,
+                    'errors': errors,
+                    'seconds': round(elapsed, 4),
+                    'throughput_rps': round(requests / elapsed, 2),
+                    'rows_per_s': round(requests * rows / elapsed, 2),
+                    'cache_hit_ratio': counter.hit_ratio(),
+                }
+                result.update(_percentiles(latencies))
+                results.append(result)
+                print("{scenario:>12} {transport:>9} c={concurrency:<3} {throughput_rps:>10.1f} req/s "
+                      "p50={p50_ms:.3f}ms p95={p95_ms:.3f}ms p99={p99_ms:.3f}ms errors={errors} "
+                      "cache hits={cache_hit_ratio}".format(**result))
+    if server is not None:
+        server.shutdown()
+    return results
+
+
+def _metadata(label):
+    import predictor
+    import settings
+
+    return {
+        'label': label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'model_path': settings.MODEL_PATH,
+        'model_version': predictor.current.version,
+        'settings': dict((name, getattr(settings, name)) for name in dir(settings)
+                         if name.isupper() and isinstance(getattr(settings, name), (str, int, float, bool))),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def _csv_list(cast):
+    return lambda value: [cast(part) for part in value.split(',') if part]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', type=_csv_list(str), default=list(SCENARIOS))
+    parser.add_argument('--transports', type=_csv_list(str), default=list(TRANSPORTS))
+    parser.add_argument('--concurrency', type=_csv_list(int), default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=1000, help="requests per scenario and level")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--batch-requests', type=int, default=100,
+                        help="batch requests per transport and level")
+    parser.add_argument('--warmup', type=int, default=10, help="untimed requests per client")
+    parser.add_argument('--no-cache', action='store_true', help="disable the prediction cache")
+    parser.add_argument('--label', default='')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+    if args.no_cache:
+        # settings are read at import, so this must happen before app is imported
+        os.environ['CAR_CACHE_SIZE'] = '0'
+
+    results = run(args.scenarios, args.transports, args.concurrency, args.requests,
+                  args.batch_size, args.batch_requests, args.warmup)
+    with open(args.output, 'w') as f:
+        json.dump({'meta': _metadata(args.label), 'results': results}, f, indent=2)
+    print("wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
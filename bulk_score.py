@@ -0,0 +1,193 @@
+"""Offline bulk scoring of listing dumps in the ``car data.csv`` schema.
+
+The input is streamed in fixed-size chunks, each chunk is encoded with the
+model's ``FeatureEncoder`` (the same encoding ``/predict`` uses) and scored
+on a process pool whose workers load the model once, in their initializer.
+At most ``--max-pending`` chunks are in flight and results are appended to
+the output in input order as soon as they are ready, so memory stays bounded
+by a few chunks whatever the size of the input.
+
+    python bulk_score.py listings.csv scored.csv --workers 4 --chunk-size 50000
+
+Parquet input and output (``.parquet``) need pyarrow.  The output holds the
+input columns plus ``Predicted_Price``; with ``--on-error skip`` rows that
+cannot be encoded are kept with an empty price and reported on stderr.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import settings
+from features import FeatureEncoder
+from model_artifact import load_model
+
+PRICE_COLUMN = 'Predicted_Price'
+
+_model = None
+_encoder = None
+
+
+def _is_parquet(path):
+    return path.lower().endswith(('.parquet', '.pq'))
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        sys.exit("Parquet input/output needs pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def read_chunks(path, chunk_size):
+    """Yield DataFrames of at most ``chunk_size`` rows from a CSV or Parquet file."""
+    if _is_parquet(path):
+        parquet = _pyarrow().parquet.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            yield chunk
+
+
+class _Writer(object):
+    """Appends scored chunks to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._parquet = None
+        self._file = None
+
+    def write(self, df):
+        if _is_parquet(self.path):
+            pyarrow = _pyarrow()
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table)
+        else:
+            if self._file is None:
+                self._file = open(self.path, 'w', newline='')
+                df.to_csv(self._file, index=False)
+            else:
+                df.to_csv(self._file, index=False, header=False)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def _init_worker(model_path):
+    global _model, _encoder
+    _model = load_model(model_path)
+    _encoder = FeatureEncoder.for_model(model_path, _model)
+
+
+def _encode(df, skip_errors):
+    """Return (X, ok) for a chunk; ``ok`` marks rows that could be encoded."""
+    try:
+        return _encoder.transform(df), np.ones(len(df), dtype=bool)
+    except (KeyError, TypeError, ValueError) as e:
+        if not skip_errors:
+            # error rows are counted within the chunk; name the chunk's input rows
+            raise ValueError("{} in input rows {}-{}".format(e, df.index[0], df.index[-1]))
+    # find the bad rows one by one; only chunks that contain one get here
+    X = np.zeros((len(df), _encoder.n_features), dtype=np.float64)
+    ok = np.zeros(len(df), dtype=bool)
+    for i in range(len(df)):
+        try:
+            X[i] = _encoder.transform(df.iloc[i:i + 1])[0]
+            ok[i] = True
+        except (KeyError, TypeError, ValueError):
+            pass
+    return X, ok
+
+
+def score_chunk(df, skip_errors=False):
+    """Return ``df`` with a ``Predicted_Price`` column (NaN for skipped rows)."""
+    X, ok = _encode(df, skip_errors)
+    prices = np.full(len(df), np.nan)
+    if ok.any():
+        prices[ok] = _model.predict(X[ok])
+    df = df.copy()
+    df[PRICE_COLUMN] = np.round(prices, 2)
+    return df
+
+
+def score_file(input_path, output_path, model_path=None, workers=None, chunk_size=50000,
+               max_pending=None, skip_errors=False, progress=None):
+    """Score ``input_path`` into ``output_path`` and return (rows, skipped)."""
+    model_path = model_path or settings.MODEL_PATH
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    writer = _Writer(output_path)
+    rows = skipped = 0
+
+    def done(df):
+        nonlocal rows, skipped
+        writer.write(df)
+        rows += len(df)
+        skipped += int(df[PRICE_COLUMN].isna().sum())
+        if progress is not None:
+            progress(rows, skipped)
+
+    try:
+        if workers == 1:
+            _init_worker(model_path)
+            for chunk in read_chunks(input_path, chunk_size):
+                done(score_chunk(chunk, skip_errors))
+            return rows, skipped
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(model_path,)) as pool:
+            pending = deque()
+            for chunk in read_chunks(input_path, chunk_size):
+                if len(pending) >= max_pending:
+                    done(pending.popleft().result())
+                pending.append(pool.submit(score_chunk, chunk, skip_errors))
+            while pending:
+                done(pending.popleft().result())
+        return rows, skipped
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input', help="CSV or Parquet file in the car data.csv schema")
+    parser.add_argument('output', help="CSV or Parquet file to write")
+    parser.add_argument('--model', default=settings.MODEL_PATH, help="pickled model or .forest artifact")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=50000, help="rows per chunk")
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help="chunks in flight at once (default: 2 per worker)")
+    parser.add_argument('--on-error', choices=('fail', 'skip'), default='fail',
+                        help="what to do with rows that cannot be encoded")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+
+    def progress(rows, skipped):
+        sys.stderr.write("\r{} rows scored, {} skipped".format(rows, skipped))
+        sys.stderr.flush()
+
+    try:
+        rows, skipped = score_file(args.input, args.output, args.model, args.workers, args.chunk_size,
+                                   args.max_pending, args.on_error == 'skip', progress)
+    except ValueError as e:
+        sys.exit("\ninvalid listing: {} (use --on-error skip to keep going)".format(e))
+    elapsed = time.perf_counter() - started
+    sys.stderr.write("\nwrote {} ({} rows, {} skipped) in {:.2f}s, {:.0f} rows/s\n".format(
+        args.output, rows, skipped, elapsed, rows / elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Measure the service's cold start: import profile and time to first prediction.
+
+Runs ``python -X importtime -c "import app"`` and prints the slowest
+imports (cumulative and self time), then starts a fresh server process and
+times, from the moment it is spawned, the first answer on the socket, the
+first 200 from ``/ready`` and the first ``/api/v1/predict`` response.  The
+server's own startup phases (``/ready``'s ``startup``) are printed too.
+Exits with status 1 when time to first prediction is over ``--budget``
+(CAR_STARTUP_BUDGET by default).
+
+    CAR_MODEL_PATH=model.forest CAR_BACKGROUND_LOAD=1 python cold_start.py --output cold.json
+"""
+import argparse
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import time
+
+import settings
+
+SERVER = ("import app, sys; from werkzeug.serving import run_simple; "
+          "run_simple('127.0.0.1', int(sys.argv[1]), app.app, threaded=True)")
+LISTING = {'Year': 2014, 'Present_Price': 5.59, 'Kms_Driven': 27000, 'Owner': 0,
+           'Fuel_Type': 'Petrol', 'Seller_Type': 'Dealer', 'Transmission': 'Manual'}
+
+
+def import_profile(module='app', top=15):
+    """Return (total seconds, [(module, cumulative, self)] slowest first)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(cumulative) / 1e6, int(own) / 1e6))
+    total = next(cumulative for name, cumulative, _ in reversed(rows) if name == module)
+    return total, sorted(rows, key=lambda row: -row[1])[:top]
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _get(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def time_to_first_prediction(timeout=60.0):
+    """Start a server and return the timings of its first responses."""
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', SERVER, str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    timings = {}
+    try:
+        deadline = started + timeout
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("server exited with status {}".format(server.returncode))
+            if time.perf_counter() > deadline:
+                raise RuntimeError("server not ready after {}s".format(timeout))
+            try:
+                status, body = _get(port, 'GET', '/ready')
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.005)
+                continue
+            timings.setdefault('listening', time.perf_counter() - started)
+            if status == 200:
+                timings['ready'] = time.perf_counter() - started
+                timings['server_phases'] = json.loads(body.decode('utf-8'))['startup']
+                break
+            time.sleep(0.005)
+        status, body = _get(port, 'POST', '/api/v1/predict', json.dumps(LISTING))
+        if status != 200:
+            raise RuntimeError("first prediction failed: {} {}".format(status, body[:200]))
+        timings['first_prediction'] = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--budget', type=float, default=settings.STARTUP_BUDGET,
+                        help="seconds allowed from spawn to the first prediction")
+    parser.add_argument('--top', type=int, default=15, help="slowest imports to list")
+    parser.add_argument('--output', default=None, help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    total, slowest = import_profile(top=args.top)
+    print("import app: {:.3f}s".format(total))
+    print("{:>10} {:>10}  {}".format('cumul s', 'self s', 'module'))
+    for name, cumulative, own in slowest:
+        print("{:>10.4f} {:>10.4f}  {}".format(cumulative, own, name))
+
+    timings = time_to_first_prediction()
+    print("model {} ({})".format(settings.MODEL_PATH,
+                                 'background load' if settings.BACKGROUND_LOAD else 'load at import'))
+    for phase in ('listening', 'ready', 'first_prediction'):
+        print("{:>18}: {:.3f}s".format(phase, timings[phase]))
+    print("server phases: {}".format(', '.join('{} {:.3f}s'.format(phase, seconds)
+                                              for phase, seconds in sorted(timings['server_phases'].items(),
+                                                                        key=lambda item: item[1]))))
+    within = timings['first_prediction'] <= args.budget
+    print("budget {:.3f}s: {}".format(args.budget, 'ok' if within else 'EXCEEDED'))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model_path': settings.MODEL_PATH, 'background_load': settings.BACKGROUND_LOAD,
+                       'import_seconds': total, 'slowest_imports': slowest, 'timings': timings,
+                       'budget': args.budget, 'within_budget': within}, f, indent=2)
+    return 0 if within else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Nearest real listings ("comparables") for a queried car.
+
+``ComparablesIndex`` holds the listings of ``car data.csv`` in a KD-tree
+(``scipy.spatial.cKDTree``) over a scaled feature space:
+
+* age (``No_Year``), ``log1p(Present_Price)`` and ``log(Kms_Driven)``,
+  standardised to unit variance, so a year of age and a standard deviation
+  of price or mileage weigh the same;
+* the fuel and transmission dummies, times CAR_COMPARABLES_CATEGORY_WEIGHT,
+  so listings with a different fuel or gearbox sort behind matching ones.
+
+Queries go through the same ``FeatureEncoder`` as the model, so they are
+validated like a prediction, and a batch is one ``cKDTree.query`` call:
+O(log n) per row, no scan of the dataset.
+
+The index is built from CAR_COMPARABLES_DATA on first use, or loaded from
+a prebuilt file given as CAR_COMPARABLES_INDEX (at startup with
+CAR_COMPARABLES_PRELOAD), which also skips pandas and the CSV parse:
+
+    python comparables.py "car data.csv" comparables.index
+"""
+import argparse
+import os
+import pickle
+import threading
+
+import numpy as np
+
+import settings
+from features import FeatureEncoder
+
+INDEX_VERSION = 1
+RECORD_FIELDS = ['Car_Name', 'Year', 'Present_Price', 'Kms_Driven', 'Fuel_Type', 'Seller_Type',
+                 'Transmission', 'Owner', 'Selling_Price']
+
+
+class ComparablesIndex(object):
+
+    def __init__(self, records, encoder, category_weight=1.0, source=None):
+        from scipy.spatial import cKDTree
+
+        self._setup(records, encoder, category_weight, source)
+        points = self._points(encoder.transform(records), fit=True)
+        self.tree = cKDTree(points)
+
+    def _setup(self, records, encoder, category_weight, source):
+        self.records = records
+        self.encoder = encoder
+        self.category_weight = category_weight
+        self.source = source
+        self._numeric = [encoder.columns.index(name) for name in ('No_Year', 'Present_Price', 'Kms_Driven')]
+        self._categorical = [j for j, field in enumerate(encoder.fields)
+                             if field in ('Fuel_Type', 'Transmission')]
+
+    @classmethod
+    def from_frame(cls, df, category_weight=1.0, source=None):
+        records = df[RECORD_FIELDS].to_dict('records')
+        for record in records:
+            for field, value in record.items():
+                # plain Python values for JSON; float32 columns rounded back
+                if isinstance(value, (float, np.floating)):
+                    record[field] = round(float(value), 4)
+                elif isinstance(value, np.integer):
+                    record[field] = int(value)
+        return cls(records, FeatureEncoder.fit(df), category_weight, source)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _points(self, X, fit=False):
+        numeric = X[:, self._numeric].copy()
+        numeric[:, 1] = np.log1p(numeric[:, 1])
+        if fit:
+            self._mean = numeric.mean(axis=0)
+            self._scale = numeric.std(axis=0)
+            self._scale[self._scale == 0] = 1.0
+        numeric = (numeric - self._mean) / self._scale
+        return np.hstack([numeric, X[:, self._categorical] * self.category_weight])
+
+    def query(self, listings, k=5):
+        """Return, per listing, its ``k`` nearest listings with their distance.
+
+        Raises ValueError for listings the encoder rejects.
+        """
+        try:
+            X = self.encoder.transform(listings)
+        except KeyError as e:
+            raise ValueError("invalid listing: missing field {}".format(e))
+        except (TypeError, ValueError) as e:
+            raise ValueError("invalid listing: {}".format(e))
+        k = min(k, len(self.records))
+        distances, indices = self.tree.query(self._points(X), k=k)
+        distances = distances.reshape(len(X), k)
+        indices = indices.reshape(len(X), k)
+        return [[dict(self.records[i], distance=round(float(d), 4)) for d, i in zip(row_d, row_i)]
+                for row_d, row_i in zip(distances, indices)]
+
+    def save(self, path):
+        """Write the built tree and its listings, as plain containers and arrays."""
+        state = {
+            'version': INDEX_VERSION,
+            'records': self.records,
+            'encoder': self.encoder.to_dict(),
+            'category_weight': self.category_weight,
+            'source': self.source,
+            'mean': self._mean,
+            'scale': self._scale,
+            'tree': self.tree,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != INDEX_VERSION:
+            raise ValueError("{} is a version {} index; rebuild it".format(path, state.get('version')))
+        index = cls.__new__(cls)
+        index._setup(state['records'], FeatureEncoder.from_dict(state['encoder']), state['category_weight'],
+                     state['source'])
+        index._mean, index._scale, index.tree = state['mean'], state['scale'], state['tree']
+        return index
+
+
+def build(data_path, category_weight=1.0):
+    from dataset import load_listings
+    from model_artifact import file_sha256
+
+    source = {'path': os.path.basename(data_path), 'sha256': file_sha256(data_path)}
+    return ComparablesIndex.from_frame(load_listings(data_path), category_weight, source)
+
+
+index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """The process-wide index, loaded or built on first use.
+
+    Raises RuntimeError when it cannot be loaded or built (a missing file,
+    no scipy); the next call tries again.
+    """
+    global index
+    if index is None:
+        with _lock:
+            if index is None:
+                try:
+                    if settings.COMPARABLES_INDEX:
+                        index = ComparablesIndex.load(settings.COMPARABLES_INDEX)
+                    else:
+                        index = build(settings.COMPARABLES_DATA, settings.COMPARABLES_CATEGORY_WEIGHT)
+                except Exception as e:
+                    raise RuntimeError("comparables are unavailable: {}".format(e))
+    return index
+
+
+def requested_k(value, default=None):
+    """Parse a ``k``/``comparables`` query parameter into 1..CAR_COMPARABLES_MAX_K."""
+    if value is None or value == '':
+        return default
+    try:
+        k = int(value)
+    except ValueError:
+        k = 0
+    if not 1 <= k <= settings.COMPARABLES_MAX_K:
+        raise ValueError("k must be an integer between 1 and {}".format(settings.COMPARABLES_MAX_K))
+    return k
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a prebuilt comparables index file.")
+    parser.add_argument('data', help="listings CSV in the car data.csv schema")
+    parser.add_argument('output', help="index file to write (use as CAR_COMPARABLES_INDEX)")
+    parser.add_argument('--category-weight', type=float, default=settings.COMPARABLES_CATEGORY_WEIGHT)
+    args = parser.parse_args(argv)
+    built = build(args.data, args.category_weight)
+    built.save(args.output)
+    print("wrote {} ({} listings)".format(args.output, len(built)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Shrink a trained forest to a tree-count, size or latency budget.
+
+Starting from the ``CompiledForest`` of a pickled model or ``.forest``
+artifact, three reductions are applied:
+
+* **tree selection** - trees are ordered by greedy forward selection (each
+  step adds the tree that most lowers the squared error of the running mean
+  on a selection set) and the forest is cut to the longest prefix that fits
+  the budget;
+* **depth capping** - with ``--max-depth`` every node at that depth becomes a
+  leaf predicting its stored value (the mean target of its samples) and the
+  subtrees below it are dropped;
+* **float32** - thresholds are rounded down to float32, which keeps every
+  split decision exact because inputs are float32 already; leaf values
+  lose precision below a cent.
+
+The holdout of ``train.holdout_split`` is halved: trees are selected on one
+half and the accuracy/size/latency trade-off is reported on the other,
+before the compressed artifact is written.
+
+    python compress_forest.py random_forest_regression_model.pkl model.forest --max-p99-ms 2
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from dataset import load_listings
+from features import FeatureEncoder
+from forest_engine import CompiledForest
+from model_artifact import file_sha256, load_model, write_artifact
+
+REPORT_SIZES = (10, 25, 50, 100, 200, 400, 800)
+
+
+def node_depths(forest):
+    """Return the depth of every node reachable from a root (-1 otherwise)."""
+    depth = np.full(forest.node_count, -1, dtype=np.intp)
+    frontier = np.asarray(forest.roots, dtype=np.intp)
+    level = 0
+    while len(frontier):
+        depth[frontier] = level
+        kids = forest.children[frontier].ravel()
+        frontier = kids[kids != np.repeat(frontier, 2)]
+        level += 1
+    return depth
+
+
+def tree_of_node(forest):
+    counts = np.diff(np.append(forest.roots, forest.node_count))
+    return np.repeat(np.arange(forest.n_trees), counts)
+
+
+def subset(forest, trees, max_depth=None, float32=True):
+    """Return a new CompiledForest with only ``trees``, optionally depth-capped."""
+    depth = node_depths(forest)
+    keep = np.isin(tree_of_node(forest), trees) & (depth >= 0)
+    if max_depth is not None:
+        keep &= depth <= max_depth
+    new_id = np.cumsum(keep) - 1
+    old = np.flatnonzero(keep)
+    children = forest.children[old]
+    feature = np.asarray(forest.feature[old])
+    if max_depth is not None:
+        # nodes on the cap become leaves with their own (mean) value
+        cut = depth[old] == max_depth
+        children[cut] = old[cut][:, None]
+        feature = np.where(cut, 0, feature)
+    threshold = np.asarray(forest.threshold[old], dtype=np.float64)
+    value = np.asarray(forest.value[old], dtype=np.float64)
+    if float32:
+        t32 = threshold.astype(np.float32)
+        # round down: for float32 x, x > t32 exactly when x > threshold
+        above = t32.astype(np.float64) > threshold
+        t32[above] = np.nextafter(t32[above], np.float32(-np.inf))
+        threshold, value = t32, value.astype(np.float32)
+    cover = None if forest.cover is None else np.asarray(forest.cover[old], dtype=np.float64)
+    roots = new_id[np.asarray(forest.roots)[np.sort(trees)]]
+    kept_depth = int(depth[old].max()) if len(old) else 0
+    return CompiledForest(feature.astype(np.intp), threshold, new_id[children].astype(np.intp), value,
+                          roots.astype(np.intp), kept_depth, forest.n_features, cover)
+
+
+def array_bytes(forest):
+    """Bytes the forest's arrays take in a .forest artifact."""
+    cover = 0 if forest.cover is None else forest.cover.dtype.itemsize
+    return (forest.node_count * (4 + 8 + forest.threshold.dtype.itemsize + forest.value.dtype.itemsize + cover)
+            + forest.n_trees * 4)
+
+
+def greedy_order(per_tree, y):
+    """Order trees by greedy forward selection on (n_trees, n_rows) predictions."""
+    n_trees = len(per_tree)
+    remaining = np.arange(n_trees)
+    total = np.zeros(per_tree.shape[1])
+    order = []
+    for k in range(1, n_trees + 1):
+        candidates = per_tree[remaining]
+        errors = (((total + candidates) / k - y) ** 2).mean(axis=1)
+        best = int(np.argmin(errors))
+        order.append(remaining[best])
+        total += candidates[best]
+        remaining = np.delete(remaining, best)
+    return np.array(order)
+
+
+def p99_ms(forest, X, samples=200):
+    """p99 latency of single-row ``predict`` calls, in milliseconds."""
+    timings = []
+    for i in range(samples):
+        row = X[i % len(X):i % len(X) + 1]
+        start = time.perf_counter()
+        forest.predict(row)
+        timings.append(time.perf_counter() - start)
+    return float(np.percentile(timings, 99) * 1000)
+
+
+def scores(forest, X, y):
+    predictions = forest.predict(X)
+    residual = y - predictions
+    return {
+        'mse': round(float((residual ** 2).mean()), 4),
+        'mae': round(float(np.abs(residual).mean()), 4),
+        'r2': round(float(1 - (residual ** 2).sum() / ((y - y.mean()) ** 2).sum()), 4),
+    }
+
+
+def _fits(candidate, max_trees, max_bytes, max_p99, X):
+    if max_trees is not None and candidate.n_trees > max_trees:
+        return False
+    if max_bytes is not None and array_bytes(candidate) > max_bytes:
+        return False
+    if max_p99 is not None and p99_ms(candidate, X) > max_p99:
+        return False
+    return True
+
+
+def compress(forest, X_select, y_select, max_trees=None, max_bytes=None, max_p99=None,
+             max_depth=None, float32=True):
+    """Return (compressed forest, greedy tree order) for the tightest budget given."""
+    order = greedy_order(forest.leaf_values(X_select), y_select)
+
+    def build(k):
+        return subset(forest, order[:k], max_depth, float32)
+
+    # the budgets grow with the tree count, so binary search the prefix length
+    lo, hi = 1, len(order)
+    if not _fits(build(lo), max_trees, max_bytes, max_p99, X_select):
+        raise ValueError("even a single tree exceeds the budget")
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _fits(build(mid), max_trees, max_bytes, max_p99, X_select):
+            lo = mid
+        else:
+            hi = mid - 1
+    return build(lo), order
+
+
+def tradeoff(forest, order, X_eval, y_eval, max_depth=None, float32=True):
+    """Rows of (trees, bytes, p99, holdout scores) for prefixes of ``order``."""
+    rows = []
+    sizes = [k for k in REPORT_SIZES if k < len(order)] + [len(order)]
+    for k in sizes:
+        candidate = subset(forest, order[:k], max_depth, float32)
+        row = {'trees': k, 'bytes': array_bytes(candidate), 'p99_ms': round(p99_ms(candidate, X_eval), 4)}
+        row.update(scores(candidate, X_eval, y_eval))
+        rows.append(row)
+    return rows
+
+
+def _holdout(model_path, model, data_path):
+    from train import _load_report, holdout_split
+
+    encoder = FeatureEncoder.for_model(model_path, model)
+    df = load_listings(data_path)
+    X = encoder.transform(df)
+    y = df['Selling_Price'].to_numpy(dtype=np.float64)
+    _, test_rows = holdout_split(len(X), _load_report(model_path).get('seed', 42))
+    return encoder, X[test_rows[0::2]], y[test_rows[0::2]], X[test_rows[1::2]], y[test_rows[1::2]]
+
+
+def _print_table(rows):
+    print("{:>7} {:>12} {:>9} {:>8} {:>8} {:>8}".format('trees', 'bytes', 'p99 ms', 'mse', 'mae', 'r2'))
+    for row in rows:
+        print("{trees:>7} {bytes:>12} {p99_ms:>9.3f} {mse:>8.4f} {mae:>8.4f} {r2:>8.4f}".format(**row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('model', help="pickled model or .forest artifact")
+    parser.add_argument('output', help=".forest artifact to write")
+    parser.add_argument('--data', default='car data.csv')
+    parser.add_argument('--max-trees', type=int, default=None)
+    parser.add_argument('--max-bytes', type=int, default=None, help="size of the tree arrays")
+    parser.add_argument('--max-p99-ms', type=float, default=None, help="single-row predict latency")
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--float64', action='store_true', help="keep float64 thresholds and values")
+    parser.add_argument('--report', default=None, help="also write the trade-off table as JSON")
+    args = parser.parse_args(argv)
+    if args.max_trees is None and args.max_bytes is None and args.max_p99_ms is None:
+        parser.error("give at least one of --max-trees, --max-bytes, --max-p99-ms")
+
+    model = load_model(args.model)
+    forest = model if isinstance(model, CompiledForest) else CompiledForest.from_estimator(model)
+    encoder, X_select, y_select, X_eval, y_eval = _holdout(args.model, model, args.data)
+    float32 = not args.float64
+    try:
+        compressed, order = compress(forest, X_select, y_select, args.max_trees, args.max_bytes,
+                                     args.max_p99_ms, args.max_depth, float32)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    original = {'trees': forest.n_trees, 'bytes': array_bytes(forest),
+                'p99_ms': round(p99_ms(forest, X_eval), 4)}
+    original.update(scores(forest, X_eval, y_eval))
+    chosen = {'trees': compressed.n_trees, 'bytes': array_bytes(compressed),
+              'p99_ms': round(p99_ms(compressed, X_eval), 4)}
+    chosen.update(scores(compressed, X_eval, y_eval))
+    rows = tradeoff(forest, order, X_eval, y_eval, args.max_depth, float32)
+    print("original")
+    _print_table([original])
+    print("greedy prefixes (max depth {}, {})".format(args.max_depth or 'unchanged',
+                                                      'float32' if float32 else 'float64'))
+    _print_table(rows)
+    print("selected")
+    _print_table([chosen])
+
+    source = {'path': args.model, 'sha256': file_sha256(args.model),
+              'compressed': {'trees': compressed.n_trees, 'max_depth': args.max_depth, 'float32': float32}}
+    write_artifact(compressed, args.output, source=source, encoder=encoder)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'original': original, 'selected': chosen, 'tradeoff': rows}, f, indent=2)
+    print("wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
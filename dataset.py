@@ -0,0 +1,83 @@
+"""Typed, cached loading of the listings dataset (the ``car data.csv`` schema).
+
+The CSV is parsed once with explicit compact dtypes: categoricals for the
+string columns, int32/int8 for the counts, float32 for ``Present_Price``
+(the forest compares features in float32 anyway).  The target stays float64
+so leaf values are unchanged.  The parsed frame is stored as a columnar
+cache file named after the CSV's SHA-256, so later runs skip parsing
+entirely and an edited CSV is never served from a stale cache.
+
+Parquet (via pyarrow) is used when available, a pickle of the frame
+otherwise; both keep the categorical dtypes.
+"""
+import os
+
+import pandas as pd
+
+from model_artifact import file_sha256
+
+CACHE_DIR = os.environ.get('CAR_DATA_CACHE_DIR', '.cache/datasets')
+
+DTYPES = {
+    'Car_Name': 'category',
+    'Year': 'int32',
+    'Selling_Price': 'float64',
+    'Present_Price': 'float32',
+    'Kms_Driven': 'int32',
+    'Fuel_Type': 'category',
+    'Seller_Type': 'category',
+    'Transmission': 'category',
+    'Owner': 'int8',
+}
+# bump when DTYPES or the parsing changes, so old cache files are ignored
+CACHE_SCHEMA = 1
+
+try:
+    import pyarrow  # noqa: F401
+    CACHE_SUFFIX = '.parquet'
+except ImportError:
+    CACHE_SUFFIX = '.pkl'
+
+
+def read_csv(path):
+    """Parse a listings CSV with the compact dtypes."""
+    return pd.read_csv(path, dtype=DTYPES)
+
+
+def cache_path_for(path, cache_dir=CACHE_DIR, digest=None):
+    digest = digest or file_sha256(path)
+    name = '{}-{}-v{}{}'.format(os.path.splitext(os.path.basename(path))[0].replace(' ', '_'),
+                                digest[:16], CACHE_SCHEMA, CACHE_SUFFIX)
+    return os.path.join(cache_dir, name)
+
+
+def _read_cache(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+def _write_cache(df, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    if path.endswith('.parquet'):
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_listings(path='car data.csv', cache_dir=CACHE_DIR, use_cache=True):
+    """Return the listings of ``path`` as a typed DataFrame, via the cache."""
+    if not use_cache:
+        return read_csv(path)
+    cache_path = cache_path_for(path, cache_dir)
+    if os.path.exists(cache_path):
+        try:
+            return _read_cache(cache_path)
+        except Exception:
+            # a corrupt or unreadable cache is rebuilt below
+            pass
+    df = read_csv(path)
+    _write_cache(df, cache_path)
+    return df
@@ -0,0 +1,219 @@
+"""Streaming feature-drift monitor for live traffic.
+
+At training time ``build_profile`` bins every listing field of the encoded
+training rows: numeric fields into (up to) ten quantile bins, categorical
+fields by category, the dropped baseline being the row with no dummy set.
+The bin edges and training proportions are saved next to the model as
+``<model>.drift.json``.
+
+While serving, ``DriftMonitor.update`` adds each encoded request to one
+fixed-size histogram per field: one comparison against the bin edges, one
+small matrix product for the dummies and a single ``bincount``, whatever
+the traffic volume.  Counts are halved
+whenever they reach CAR_DRIFT_WINDOW rows, so the histograms follow recent
+traffic instead of everything since startup.  ``report`` compares them with
+the reference through the population stability index::
+
+    PSI = sum_b (live_b - ref_b) * ln(live_b / ref_b)
+
+read as stable below 0.1, moderate up to 0.25 and drifted above.  Only
+encoded values are seen: a listing the form already mislabelled (its CNG
+option posts Diesel) counts as Diesel.
+
+For models trained before profiles existed, build one from their training
+rows with
+
+    python drift.py random_forest_regression_model.pkl --data "car data.csv"
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from features import CATEGORICAL_FIELDS, NUMERIC_FIELDS
+
+PROFILE_VERSION = 1
+NUMERIC_BINS = 10
+# PSI thresholds for 'moderate' and 'drift'
+MODERATE_PSI = 0.1
+DRIFT_PSI = 0.25
+# smoothing for empty bins, so PSI stays finite
+_EPSILON = 1e-4
+
+
+def drift_path_for(model_path):
+    return os.path.splitext(model_path)[0] + '.drift.json'
+
+
+def build_profile(X, encoder, bins=NUMERIC_BINS):
+    """Return the reference profile of the encoded training rows ``X``."""
+    X = np.asarray(X, dtype=np.float32)
+    fields = {}
+    for field in NUMERIC_FIELDS:
+        column = encoder.fields.index(field)
+        interior = np.quantile(X[:, column], np.linspace(0, 1, bins + 1)[1:-1])
+        fields[field] = {'kind': 'numeric', 'column': column,
+                         'edges': [float(edge) for edge in np.unique(interior)]}
+    for field in CATEGORICAL_FIELDS:
+        fields[field] = {'kind': 'categorical', 'categories': list(encoder.categories[field]),
+                         'columns': [j for j, name in enumerate(encoder.fields) if name == field]}
+    monitor = DriftMonitor({'fields': fields})
+    monitor.update(X)
+    for field, spec in fields.items():
+        spec['proportions'] = [round(float(p), 6) for p in monitor.proportions(field)]
+    return {'version': PROFILE_VERSION, 'rows': len(X), 'columns': list(encoder.columns),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'fields': fields}
+
+
+def save_profile(profile, path):
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+
+
+def load_profile(model_path):
+    """Return the profile saved with a model, or None."""
+    try:
+        with open(drift_path_for(model_path)) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return profile if profile.get('version') == PROFILE_VERSION else None
+
+
+def psi(live, reference):
+    live = np.clip(live, _EPSILON, None)
+    reference = np.clip(reference, _EPSILON, None)
+    return float(np.sum((live - reference) * np.log(live / reference)))
+
+
+def _status(value):
+    if value < MODERATE_PSI:
+        return 'stable'
+    return 'moderate' if value < DRIFT_PSI else 'drift'
+
+
+class DriftMonitor(object):
+
+    def __init__(self, profile, window=10000, min_rows=100):
+        self.profile = profile
+        self.window = window
+        self.min_rows = min_rows
+        self._fields = []
+        numeric, categorical = [], []
+        offset = 0
+        for field, spec in profile['fields'].items():
+            if spec['kind'] == 'numeric':
+                size = len(spec['edges']) + 1
+                numeric.append((spec['column'], spec['edges'], offset))
+            else:
+                size = len(spec['categories'])
+                categorical.append((spec['columns'], offset))
+            self._fields.append((field, offset, size))
+            offset += size
+        # every field is binned in one pass: numeric columns against their
+        # edges (padded with +inf), one-hot dummies through a rank matrix
+        # (the set column's rank + 1, 0 for the baseline)
+        width = max([len(edges) for _, edges, _ in numeric] or [0])
+        self._numeric_columns = np.array([column for column, _, _ in numeric], dtype=np.intp)
+        self._edges = np.full((len(numeric), width), np.inf, dtype=np.float32)
+        for i, (_, edges, _) in enumerate(numeric):
+            self._edges[i, :len(edges)] = edges
+        # a field seen with one category has no dummy and bins all in its baseline
+        n_columns = 1 + max([column for column, _, _ in numeric] +
+                            [max(columns) for columns, _ in categorical if columns])
+        self._ranks = np.zeros((n_columns, len(categorical)), dtype=np.float32)
+        for i, (columns, _) in enumerate(categorical):
+            self._ranks[columns, i] = np.arange(1, len(columns) + 1)
+        self._offsets = np.array([o for _, _, o in numeric] + [o for _, o in categorical], dtype=np.intp)
+        self._lock = threading.Lock()
+        self.counts = np.zeros(offset)
+        self.rows = 0.0
+        self.seen = 0
+
+    def update(self, X):
+        """Add encoded rows to the live histograms."""
+        # binned as float32, like the training rows the edges came from
+        X = np.asarray(X, dtype=np.float32)
+        numeric = (X[:, self._numeric_columns, None] > self._edges).sum(axis=2)
+        categorical = (X[:, :len(self._ranks)] @ self._ranks).astype(np.intp)
+        bins = np.hstack([numeric, categorical]) + self._offsets
+        counts = np.bincount(bins.ravel(), minlength=len(self.counts))
+        with self._lock:
+            self.counts += counts
+            self.rows += len(X)
+            self.seen += len(X)
+            if self.rows >= self.window:
+                self.counts *= 0.5
+                self.rows *= 0.5
+
+    def proportions(self, field):
+        for name, offset, size in self._fields:
+            if name == field:
+                with self._lock:
+                    counts = self.counts[offset:offset + size].copy()
+                total = counts.sum()
+                return counts / total if total else counts
+        raise KeyError(field)
+
+    def reset(self):
+        with self._lock:
+            self.counts[:] = 0
+            self.rows = 0.0
+            self.seen = 0
+
+    def scores(self):
+        """PSI of every field against the reference; None before min_rows."""
+        if self.rows < self.min_rows:
+            return dict((field, None) for field, _, _ in self._fields)
+        return dict((field, psi(self.proportions(field), self.profile['fields'][field]['proportions']))
+                    for field, _, _ in self._fields)
+
+    def report(self):
+        fields = {}
+        for field, value in self.scores().items():
+            spec = self.profile['fields'][field]
+            entry = {
+                'psi': None if value is None else round(value, 4),
+                'status': 'insufficient_data' if value is None else _status(value),
+                'reference': spec['proportions'],
+                'live': [round(float(p), 4) for p in self.proportions(field)],
+            }
+            if spec['kind'] == 'numeric':
+                entry['column'] = self.profile['columns'][spec['column']]
+                entry['edges'] = [round(edge, 4) for edge in spec['edges']]
+            else:
+                entry['categories'] = spec['categories']
+            fields[field] = entry
+        return {
+            'reference_rows': self.profile['rows'],
+            'reference_created': self.profile.get('created'),
+            'rows_seen': self.seen,
+            'window_weight': round(self.rows, 1),
+            'fields': fields,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the drift reference profile of a trained model.")
+    parser.add_argument('model', help="pickled model or .forest artifact")
+    parser.add_argument('--data', default='car data.csv', help="the listings the model was trained on")
+    args = parser.parse_args(argv)
+
+    from dataset import load_listings
+    from features import FeatureEncoder
+    from model_artifact import load_model
+    from train import _load_report, holdout_split, training_matrix
+
+    encoder = FeatureEncoder.for_model(args.model, load_model(args.model))
+    X, _ = training_matrix(load_listings(args.data), encoder)
+    train_rows, _ = holdout_split(len(X), _load_report(args.model).get('seed', 42))
+    profile = build_profile(X[train_rows], encoder)
+    save_profile(profile, drift_path_for(args.model))
+    print("wrote {} ({} rows)".format(drift_path_for(args.model), profile['rows']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""Compact JSON encoding for the machine-facing API, using orjson when installed."""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPE = 'application/json'
+
+
+def dumps(obj):
+    """Serialize ``obj`` to compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def loads(data):
+    # both decoders raise a ValueError subclass on bad input
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
@@ -0,0 +1,176 @@
+"""Feature encoding shared by training, bulk scoring and serving.
+
+``FeatureEncoder`` turns listings in the ``car data.csv`` schema (or the
+field names posted by ``templates/index.html``) into the matrix the random
+forest is trained on.  Its column layout matches
+``pd.get_dummies(..., drop_first=True)`` in the training notebook: numeric
+columns first, then one dummy per non-baseline category.  Categories are
+resolved through precomputed value-to-column lookup tables, so a whole
+DataFrame or a batch of dicts is encoded with a few array operations and no
+per-row branching.
+
+The encoder is fitted with the model and saved next to it as JSON
+(``<model>.encoder.json``), or embedded in a ``.forest`` artifact header.
+"""
+import json
+import os
+
+import numpy as np
+
+CURRENT_YEAR = 2020
+
+NUMERIC_FIELDS = ['Present_Price', 'Kms_Driven', 'Owner', 'Year']
+CATEGORICAL_FIELDS = ['Fuel_Type', 'Seller_Type', 'Transmission']
+
+# categories of car data.csv; the first one of each is the dropped baseline
+DEFAULT_CATEGORIES = {
+    'Fuel_Type': ['CNG', 'Diesel', 'Petrol'],
+    'Seller_Type': ['Dealer', 'Individual'],
+    'Transmission': ['Automatic', 'Manual'],
+}
+
+# values index.html posts that differ from the dataset's spelling
+ALIASES = {
+    'Transmission': {'Mannual': 'Manual'},
+}
+
+# index.html posts the dummy column names with the category as the value
+FORM_FIELDS = {
+    'Fuel_Type_Petrol': 'Fuel_Type',
+    'Seller_Type_Individual': 'Seller_Type',
+    'Transmission_Mannual': 'Transmission',
+}
+
+
+def normalize_listing(listing):
+    """Return ``listing`` keyed by the ``car data.csv`` column names."""
+    row = dict(listing)
+    for form_name, column in FORM_FIELDS.items():
+        if form_name in row and column not in row:
+            row[column] = row.pop(form_name)
+    return row
+
+
+def encoder_path_for(model_path):
+    return os.path.splitext(model_path)[0] + '.encoder.json'
+
+
+def _check(name, values, valid, expected):
+    bad = ~(np.isfinite(values) & valid)
+    if bad.any():
+        row = int(np.argmax(bad))
+        raise ValueError("{} must be {} (row {}: {!r})".format(name, expected, row, float(values[row])))
+
+
+class FeatureEncoder(object):
+
+    def __init__(self, categories=None, current_year=CURRENT_YEAR, log_kms=True):
+        self.categories = dict((field, list(values)) for field, values in
+                               (categories or DEFAULT_CATEGORIES).items())
+        self.current_year = current_year
+        self.log_kms = log_kms
+        self.columns = ['Present_Price', 'Kms_Driven', 'Owner', 'No_Year']
+        # the listing field each column is derived from
+        self.fields = list(NUMERIC_FIELDS)
+        self._lookup = {}
+        for field in CATEGORICAL_FIELDS:
+            # the baseline category has no column of its own
+            table = {self.categories[field][0]: -1}
+            for value in self.categories[field][1:]:
+                table[value] = len(self.columns)
+                self.columns.append('{}_{}'.format(field, value))
+                self.fields.append(field)
+            for alias, value in ALIASES.get(field, {}).items():
+                if value in table:
+                    table[alias] = table[value]
+            self._lookup[field] = table
+
+    @property
+    def n_features(self):
+        return len(self.columns)
+
+    @classmethod
+    def fit(cls, df, current_year=CURRENT_YEAR, log_kms=True):
+        """Learn the category tables from a DataFrame in the car data.csv schema."""
+        categories = dict((field, sorted(df[field].astype(str).unique()))
+                          for field in CATEGORICAL_FIELDS)
+        return cls(categories, current_year=current_year, log_kms=log_kms)
+
+    def _columns(self, data):
+        if hasattr(data, 'columns'):
+            return dict((name, data[name].to_numpy()) for name in NUMERIC_FIELDS + CATEGORICAL_FIELDS)
+        if isinstance(data, dict):
+            data = [data]
+        rows = [normalize_listing(listing) for listing in data]
+        return dict((name, np.array([row[name] for row in rows]))
+                    for name in NUMERIC_FIELDS + CATEGORICAL_FIELDS)
+
+    def transform(self, data):
+        """Encode a DataFrame, a list of listing dicts or a single dict.
+
+        Raises KeyError for a missing field, ValueError or TypeError for a
+        value that cannot be converted and ValueError for one out of range
+        or a category the encoder does not know.
+        """
+        columns = self._columns(data)
+        n = len(columns['Year'])
+        X = np.zeros((n, self.n_features), dtype=np.float64)
+        if not n:
+            return X
+        price = columns['Present_Price'].astype(np.float64)
+        kms = columns['Kms_Driven'].astype(np.float64)
+        owner = columns['Owner'].astype(np.float64)
+        year = columns['Year'].astype(np.float64)
+        _check('Present_Price', price, price >= 0, "a non-negative number")
+        _check('Kms_Driven', kms, kms > 0 if self.log_kms else kms >= 0, "a positive number")
+        _check('Owner', owner, owner >= 0, "a non-negative number")
+        _check('Year', year, True, "a number")
+        X[:, 0] = price
+        X[:, 1] = np.log(kms) if self.log_kms else kms
+        X[:, 2] = owner
+        X[:, 3] = self.current_year - year
+        rows = np.arange(n)
+        for field in CATEGORICAL_FIELDS:
+            values, inverse = np.unique(columns[field].astype(str), return_inverse=True)
+            table = self._lookup[field]
+            unknown = [str(value) for value in values if value not in table]
+            if unknown:
+                row = int(np.argmax(columns[field].astype(str) == unknown[0]))
+                raise ValueError("{} must be one of {} (row {}: {!r})".format(
+                    field, ', '.join(self.categories[field]), row, unknown[0]))
+            cols = np.array([table[value] for value in values], dtype=np.intp)[inverse.ravel()]
+            hit = cols >= 0
+            X[rows[hit], cols[hit]] = 1.0
+        return X
+
+    def to_dict(self):
+        return {
+            'categories': self.categories,
+            'current_year': self.current_year,
+            'log_kms': self.log_kms,
+            'columns': self.columns,
+        }
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(spec['categories'], current_year=spec['current_year'], log_kms=spec['log_kms'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def for_model(cls, model_path, model=None):
+        """Return the encoder stored with a model, or the default one."""
+        header = getattr(model, 'header', None) or {}
+        if header.get('encoder'):
+            return cls.from_dict(header['encoder'])
+        path = encoder_path_for(model_path)
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls()
@@ -0,0 +1,177 @@
+"""Array-backed evaluator for the fitted random forest.
+
+``CompiledForest.from_estimator`` flattens every tree of a fitted
+``RandomForestRegressor`` (or a search object wrapping one) into a handful of
+contiguous NumPy arrays (feature, threshold, children, value).  ``predict``
+then walks all trees for all rows at
+once, one tree level per iteration, and reproduces ``model.predict`` bit for
+bit: inputs are cast to float32 like sklearn does, thresholds are compared in
+float64 and per-tree outputs are summed in estimator order before dividing by
+the number of trees.
+
+Run ``python forest_engine.py [model.pkl]`` to check the outputs against
+``model.predict`` and benchmark both on 1, 10 and 10k rows.
+"""
+import sys
+import time
+
+import numpy as np
+
+# keep the (trees x rows) working set of one chunk around a few MB
+_CHUNK_CELLS = 1 << 18
+
+
+def unwrap_forest(model):
+    """Return the fitted forest inside a search object, or the model itself."""
+    return getattr(model, 'best_estimator_', model)
+
+
+class CompiledForest(object):
+
+    def __init__(self, feature, threshold, children, value, roots, max_depth, n_features, cover=None):
+        self.feature = feature
+        self.threshold = threshold
+        # (node_count, 2) array of [left, right] global node ids
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        # weighted training samples per node; only explain.py needs it
+        self.cover = cover
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def node_count(self):
+        return len(self.feature)
+
+    @classmethod
+    def from_estimator(cls, model):
+        forest = unwrap_forest(model)
+        trees = [est.tree_ for est in forest.estimators_]
+        if any(tree.n_outputs != 1 for tree in trees):
+            raise ValueError("only single-output regression forests are supported")
+        counts = np.array([tree.node_count for tree in trees], dtype=np.intp)
+        roots = np.zeros(len(trees), dtype=np.intp)
+        roots[1:] = np.cumsum(counts)[:-1]
+        total = int(counts.sum())
+
+        feature = np.zeros(total, dtype=np.intp)
+        threshold = np.zeros(total, dtype=np.float64)
+        children = np.empty((total, 2), dtype=np.intp)
+        value = np.empty(total, dtype=np.float64)
+        cover = np.empty(total, dtype=np.float64)
+        for root, tree in zip(roots, trees):
+            nodes = slice(root, root + tree.node_count)
+            own = np.arange(root, root + tree.node_count)
+            leaf = tree.children_left == -1
+            # leaves point back at themselves so extra iterations are no-ops
+            feature[nodes] = np.where(leaf, 0, tree.feature)
+            threshold[nodes] = tree.threshold
+            children[nodes, 0] = np.where(leaf, own, tree.children_left + root)
+            children[nodes, 1] = np.where(leaf, own, tree.children_right + root)
+            value[nodes] = tree.value[:, 0, 0]
+            cover[nodes] = tree.weighted_n_node_samples
+        max_depth = max(tree.max_depth for tree in trees)
+        n_features = getattr(forest, 'n_features_in_', None) or forest.n_features_
+        return cls(feature, threshold, children, value, roots, max_depth, n_features, cover)
+
+    def _check_input(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError("expected rows with {} features, got shape {}".format(self.n_features, X.shape))
+        if not np.isfinite(X).all():
+            raise ValueError("input contains NaN or infinity")
+        return X.astype(np.float64)
+
+    def leaf_values(self, X):
+        """Return the (n_trees, n_rows) matrix of per-tree predictions."""
+        X = self._check_input(X)
+        chunk = max(1, _CHUNK_CELLS // self.n_trees)
+        out = np.empty((self.n_trees, len(X)), dtype=self.value.dtype)
+        for start in range(0, len(X), chunk):
+            rows = X[start:start + chunk]
+            out[:, start:start + chunk] = self.value[self._walk(rows)]
+        return out
+
+    def _walk(self, X):
+        flat_x = X.ravel()
+        row_offset = np.arange(len(X)) * self.n_features
+        flat_children = self.children.reshape(-1)
+        node = np.repeat(self.roots[:, None], len(X), axis=1)
+        for _ in range(self.max_depth):
+            x = np.take(flat_x, np.take(self.feature, node) + row_offset)
+            go_right = x > np.take(self.threshold, node)
+            node = np.take(flat_children, node * 2 + go_right)
+        return node
+
+    def _mean(self, per_tree):
+        # cumsum accumulates strictly in tree order, matching sklearn's += loop
+        return np.cumsum(per_tree, axis=0, dtype=np.float64)[-1] / self.n_trees
+
+    def predict(self, X):
+        return self._mean(self.leaf_values(X))
+
+    def predict_quantiles(self, X, quantiles):
+        """Return the mean prediction and the quantiles of the per-tree predictions.
+
+        Both come from the same pass over the trees; the mean equals
+        ``predict(X)``.  The quantiles have shape (len(quantiles), n_rows).
+        """
+        X = self._check_input(X)
+        chunk = max(1, _CHUNK_CELLS // self.n_trees)
+        mean = np.empty(len(X), dtype=np.float64)
+        spread = np.empty((len(quantiles), len(X)), dtype=np.float64)
+        for start in range(0, len(X), chunk):
+            per_tree = self.value[self._walk(X[start:start + chunk])]
+            mean[start:start + chunk] = self._mean(per_tree)
+            spread[:, start:start + chunk] = np.quantile(per_tree, quantiles, axis=0)
+        return mean, spread
+
+
+def _sample_rows(n, seed=0):
+    from dataset import load_listings
+    from features import FeatureEncoder
+
+    X = FeatureEncoder().transform(load_listings('car data.csv'))
+    return X[np.random.RandomState(seed).randint(0, len(X), size=n)]
+
+
+def _best_ms(fn, X, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(X)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def benchmark(model, sizes=(1, 10, 10000), repeat=20):
+    compiled = CompiledForest.from_estimator(model)
+    results = []
+    for n in sizes:
+        X = _sample_rows(n)
+        expected = model.predict(X)
+        if not np.array_equal(expected, compiled.predict(X)):
+            raise AssertionError("compiled forest disagrees with model.predict on {} rows".format(n))
+        reps = max(3, repeat // 10) if n >= 1000 else repeat
+        results.append((n, _best_ms(model.predict, X, reps), _best_ms(compiled.predict, X, reps)))
+    return results
+
+
+if __name__ == "__main__":
+    import pickle
+
+    path = sys.argv[1] if len(sys.argv) > 1 else 'random_forest_regression_model.pkl'
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+    forest = unwrap_forest(model)
+    print("{} trees, max depth {}".format(len(forest.estimators_), max(e.tree_.max_depth for e in forest.estimators_)))
+    print("{:>8} {:>14} {:>14} {:>8}".format('rows', 'sklearn ms', 'compiled ms', 'speedup'))
+    for n, sk_ms, comp_ms in benchmark(model):
+        print("{:>8} {:>14.3f} {:>14.3f} {:>7.1f}x".format(n, sk_ms, comp_ms, sk_ms / comp_ms))
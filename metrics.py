@@ -0,0 +1,230 @@
+"""Low-overhead counters and histograms rendered in Prometheus text format.
+
+Every metric keeps one plain list of numbers per thread.  Recording only
+touches the calling thread's list, so the hot path takes no lock; a scrape
+sums the lists.  Lists of threads that have exited are folded into a
+retired total the next time a new thread registers, so per-connection
+server threads don't grow memory.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+# seconds; the stages of one /predict call are mostly sub-millisecond
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+# absolute price differences (lakhs) between the shadow and serving models
+DELTA_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+class _Shards(object):
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._live = []
+        self._retired = [0] * size
+
+    def get(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0] * self._size
+            with self._lock:
+                live = []
+                for thread, other in self._live:
+                    if thread.is_alive():
+                        live.append((thread, other))
+                    else:
+                        self._retired = [a + b for a, b in zip(self._retired, other)]
+                live.append((threading.current_thread(), shard))
+                self._live = live
+            self._local.shard = shard
+            return shard
+
+    def totals(self):
+        with self._lock:
+            totals = list(self._retired)
+            for _, shard in self._live:
+                totals = [a + b for a, b in zip(totals, shard)]
+        return totals
+
+
+class Counter(object):
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.get()[0] += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self._shards.totals()[0]
+
+
+class Gauge(object):
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # one slot per bucket, one for +Inf, then sum and count
+        self._shards = _Shards(len(self.buckets) + 3)
+
+    def observe(self, value):
+        shard = self._shards.get()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        totals = self._shards.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            yield name + '_bucket', labels + (('le', le),), cumulative
+        yield name + '_sum', labels, totals[-2]
+        yield name + '_count', labels, totals[-1]
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Family(object):
+    """A named metric, optionally split by labels."""
+
+    def __init__(self, kind, name, help, labelnames=(), **kwargs):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._factory = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}[kind]
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._factory(**kwargs)
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory(**self._kwargs))
+        return child
+
+    def __getattr__(self, attr):
+        # unlabelled families forward inc/set/observe/time to their only child
+        if attr.startswith('_') or self.labelnames:
+            raise AttributeError(attr)
+        return getattr(self._children[()], attr)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        # labels() may add a child from a request thread meanwhile
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return lines
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def counter(name, help, labelnames=()):
+    return Family('counter', name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return Family('gauge', name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return Family('histogram', name, help, labelnames, buckets=buckets)
+
+
+class Stages(object):
+    """Records the time between successive ``mark`` calls as request stages."""
+
+    def __init__(self, route):
+        self.route = route
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        STAGE_SECONDS.labels(self.route, stage).observe(now - self.last)
+        self.last = now
+
+
+def render():
+    with _registry_lock:
+        families = list(_registry)
+    lines = []
+    for family in families:
+        lines.extend(family.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = histogram('car_stage_seconds', "Time spent in each stage of a prediction request.",
+                          ['route', 'stage'])
+REQUESTS = counter('car_requests_total', "Prediction requests by route and outcome.",
+                   ['route', 'outcome'])
+BATCH_SIZE = histogram('car_batch_size', "Rows per model call, per request or per coalesced batch.",
+                       ['source'], buckets=BATCH_SIZE_BUCKETS)
+MODEL_LOAD_SECONDS = gauge('car_model_load_seconds', "Time taken to load the serving model.")
+MODEL_INFO = gauge('car_model_info', "Unix time the serving model version was loaded; 0 once replaced.", ['version'])
+MODEL_RELOADS = counter('car_model_reloads_total', "Model reload attempts by outcome.", ['outcome'])
+CACHE_EVENTS = gauge('car_prediction_cache', "Prediction cache counters and current size.", ['stat'])
+SHADOW_EVENTS = counter('car_shadow_total', "Shadow evaluations by outcome (scored, dropped, failed, write_failed).",
+                        ['outcome'])
+SHADOW_ABS_DELTA = histogram('car_shadow_abs_delta', "Absolute difference between shadow and serving predictions.",
+                             buckets=DELTA_BUCKETS)
+STARTUP_SECONDS = gauge('car_startup_seconds', "Seconds from process start to the end of each startup phase.",
+                        ['phase'])
+DRIFT_PSI = gauge('car_feature_drift_psi', "Population stability index of live traffic against the training profile.",
+                  ['field'])
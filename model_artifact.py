@@ -0,0 +1,166 @@
+"""Compact, memory-mappable on-disk format for the fitted forest.
+
+A ``.forest`` file holds only what serving needs: the flattened tree arrays
+of ``forest_engine.CompiledForest``, without the search object and its CV
+results.  Layout::
+
+    8 bytes   magic  b'CARFRST\\0'
+    4 bytes   little-endian uint32 header length
+    N bytes   UTF-8 JSON header (format version, shapes, dtypes, offsets,
+              and the model's FeatureEncoder)
+    ...       raw little-endian arrays, each aligned to 64 bytes
+
+``load_artifact`` memory-maps the file read-only, so every worker process
+that loads the same artifact shares one copy of the trees in the page cache.
+
+Export a pickled model with::
+
+    python model_artifact.py random_forest_regression_model.pkl model.forest
+"""
+import hashlib
+import json
+import os
+import pickle
+import struct
+import sys
+import time
+
+import numpy as np
+
+from features import FeatureEncoder
+from forest_engine import CompiledForest
+
+MAGIC = b'CARFRST\0'
+# version 2 added the optional 'cover' array
+FORMAT_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+ALIGNMENT = 64
+ARTIFACT_SUFFIX = '.forest'
+
+# on-disk dtypes; node ids fit comfortably in int32 and halve the file size
+ARRAY_DTYPES = {
+    'feature': '<i4',
+    'threshold': '<f8',
+    'children': '<i4',
+    'value': '<f8',
+    'roots': '<i4',
+    'cover': '<f8',
+}
+# a forest whose thresholds/values are already float32 (compress_forest.py)
+# is stored as float32; the loader takes every dtype from the header
+FLOAT32_ARRAYS = ('threshold', 'value')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_artifact(forest, path, source=None, encoder=None):
+    """Write a CompiledForest (and optionally its FeatureEncoder) to ``path``."""
+    arrays = {}
+    for name, dtype in ARRAY_DTYPES.items():
+        array = getattr(forest, name)
+        if array is None:
+            continue
+        if name in FLOAT32_ARRAYS and array.dtype == np.float32:
+            dtype = '<f4'
+        arrays[name] = np.ascontiguousarray(array, dtype=dtype)
+    header = {
+        'format_version': FORMAT_VERSION,
+        'n_features': forest.n_features,
+        'n_trees': forest.n_trees,
+        'max_depth': forest.max_depth,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'source': source or {},
+        'encoder': encoder.to_dict() if encoder is not None else None,
+        'arrays': {},
+    }
+    # offsets depend on the header size, so lay out with a placeholder
+    # header first and grow it until the encoded length is stable
+    header_len = 0
+    while True:
+        offset = _align(len(MAGIC) + 4 + header_len)
+        for name, array in arrays.items():
+            header['arrays'][name] = {
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'offset': offset,
+            }
+            offset = _align(offset + array.nbytes)
+        encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+        if len(encoded) == header_len:
+            break
+        header_len = len(encoded)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(encoded)))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+    return header
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a forest artifact".format(path))
+        (header_len,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header.get('format_version') not in READABLE_VERSIONS:
+        raise ValueError("unsupported forest artifact version {!r} in {}".format(
+            header.get('format_version'), path))
+    return header
+
+
+def load_artifact(path):
+    """Memory-map a ``.forest`` file and return a read-only CompiledForest."""
+    header = read_header(path)
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(buf, dtype=spec['dtype'], count=count,
+                                     offset=spec['offset']).reshape(spec['shape'])
+    forest = CompiledForest(arrays['feature'], arrays['threshold'], arrays['children'],
+                            arrays['value'], arrays['roots'], header['max_depth'],
+                            header['n_features'], arrays.get('cover'))
+    forest.header = header
+    return forest
+
+
+def load_model(path):
+    """Load a pickled sklearn model or a ``.forest`` artifact."""
+    if path.endswith(ARTIFACT_SUFFIX):
+        return load_artifact(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def export(pickle_path, artifact_path):
+    with open(pickle_path, 'rb') as f:
+        model = pickle.load(f)
+    forest = CompiledForest.from_estimator(model)
+    source = {'path': os.path.basename(pickle_path), 'sha256': file_sha256(pickle_path)}
+    encoder = FeatureEncoder.for_model(pickle_path)
+    return write_artifact(forest, artifact_path, source=source, encoder=encoder)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python model_artifact.py MODEL.pkl OUTPUT.forest")
+    header = export(sys.argv[1], sys.argv[2])
+    print("wrote {} ({} trees, {} bytes)".format(
+        sys.argv[2], header['n_trees'], os.path.getsize(sys.argv[2])))
@@ -0,0 +1,120 @@
+"""Bounded LRU + TTL cache in front of model.predict.
+
+Keys are the encoded 8-feature rows.  ``Present_Price`` and ``Kms_Driven``
+can be quantized to a step before lookup so near-identical listings share
+an entry; the quantized row is also what gets scored, so a prediction never
+depends on which listing happened to fill the cache first.  The cache drops
+everything when the serving model's version changes, including a rollback
+to an earlier model file; requests still pinned to a replaced model bypass
+it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+PRICE_COLUMN = 0
+KMS_COLUMN = 1  # holds log(Kms_Driven)
+
+
+class PredictionCache(object):
+
+    def __init__(self, maxsize=10000, ttl=3600.0, price_step=0.0, kms_step=0, width=None):
+        self.maxsize = maxsize
+        # values per row: None for one prediction, n for a vector (explanations)
+        self.width = width
+        self.ttl = ttl
+        self.price_step = price_step
+        self.kms_step = kms_step
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def quantize(self, X):
+        X = np.array(X, dtype=np.float64, ndmin=2)
+        if self.price_step:
+            X[:, PRICE_COLUMN] = np.round(X[:, PRICE_COLUMN] / self.price_step) * self.price_step
+        if self.kms_step:
+            kms = np.maximum(np.round(np.exp(X[:, KMS_COLUMN]) / self.kms_step), 1) * self.kms_step
+            X[:, KMS_COLUMN] = np.log(kms)
+        return X
+
+    def _check_version(self, version, current):
+        """Adopt the serving model's version; return False for a replaced model."""
+        if version is None or version == self._version:
+            return True
+        if not current:
+            return False
+        if self._version is not None:
+            self._entries.clear()
+            self.invalidations += 1
+        self._version = version
+        return True
+
+    def predict(self, predict_fn, X, version=None, current=True):
+        """Return predictions for ``X``, calling ``predict_fn`` once for all misses.
+
+        ``current`` is False for requests still running on a model that has
+        since been replaced: they bypass the cache instead of mixing old
+        predictions into it.
+        """
+        X = self.quantize(X)
+        keys = [row.tobytes() for row in X]
+        out = np.empty((len(keys), self.width) if self.width else len(keys), dtype=np.float64)
+        missing = OrderedDict()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._check_version(version, current)
+            for i, key in enumerate(keys if cached else ()):
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] < now:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    out[i] = entry[0]
+                    self.hits += 1
+        if not cached:
+            with self._lock:
+                self.misses += len(keys)
+            return np.asarray(predict_fn(X), dtype=np.float64)
+        if not missing:
+            return out
+
+        rows = [positions[0] for positions in missing.values()]
+        values = predict_fn(X[rows])
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            # the model may have been swapped while predict_fn ran
+            store = version is None or version == self._version
+            for (key, positions), value in zip(missing.items(), values):
+                out[positions] = value
+                if store:
+                    self._entries[key] = (value, expires)
+                    self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
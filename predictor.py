@@ -0,0 +1,558 @@
+"""Model loading and the scoring pipeline shared by app.py and asgi.py.
+
+``current`` is the serving ``LoadedModel`` (model, encoder, version).  A
+request reads it once and passes it along, so a hot reload, which builds
+and warms a new ``LoadedModel`` before replacing the reference, never
+changes the model under a request that is already running.  Reloads come
+from the file watcher (CAR_RELOAD_INTERVAL) or ``reload_model()``.
+
+The first model is loaded and warmed up at import, or with
+CAR_BACKGROUND_LOAD on a background thread; ``current`` is None and
+``readiness()`` reports not ready until it is serving.  Startup phases are
+timed from process start and checked against CAR_STARTUP_BUDGET.
+
+``score`` runs encoded rows through the prediction cache, the optional
+micro-batcher and finally the sklearn or compiled forest.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import comparables
+import drift
+import metrics
+import settings
+from coalescer import MicroBatcher
+from explain import TreeExplainer
+from features import CATEGORICAL_FIELDS, NUMERIC_FIELDS, FeatureEncoder
+from forest_engine import CompiledForest
+from model_artifact import file_sha256, load_model
+from prediction_cache import PredictionCache
+
+log = logging.getLogger(__name__)
+
+# scored by every freshly loaded model before it starts serving
+WARMUP_LISTINGS = [
+    {'Year': 2014, 'Present_Price': 5.59, 'Kms_Driven': 27000, 'Owner': 0,
+     'Fuel_Type': 'Petrol', 'Seller_Type': 'Dealer', 'Transmission': 'Manual'},
+    {'Year': 2013, 'Present_Price': 9.54, 'Kms_Driven': 43000, 'Owner': 0,
+     'Fuel_Type': 'Diesel', 'Seller_Type': 'Dealer', 'Transmission': 'Manual'},
+    {'Year': 2010, 'Present_Price': 0.57, 'Kms_Driven': 24000, 'Owner': 0,
+     'Fuel_Type': 'Petrol', 'Seller_Type': 'Individual', 'Transmission': 'Automatic'},
+]
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class LoadedModel(object):
+    """A model together with its encoder and version, swapped as one unit."""
+
+    def __init__(self, path):
+        started = time.perf_counter()
+        self.path = path
+        self.signature = _file_signature(path)
+        self.version = file_sha256(path)[:12]
+        self.model = load_model(path)
+        self.encoder = FeatureEncoder.for_model(path, self.model)
+        self.compiled = None
+        if isinstance(self.model, CompiledForest):
+            self.compiled = self.model
+        elif settings.INFERENCE_ENGINE == 'compiled':
+            self.compiled = CompiledForest.from_estimator(self.model)
+        self._per_tree = self.compiled
+        self._explainer = None
+        self.explanations = None
+        if settings.EXPLAIN_CACHE_SIZE > 0:
+            self.explanations = PredictionCache(settings.EXPLAIN_CACHE_SIZE, ttl=settings.CACHE_TTL,
+                                                width=self.encoder.n_features)
+        self.drift = None
+        profile = drift.load_profile(path) if settings.DRIFT_MONITOR else None
+        if profile is not None and profile['columns'] == self.encoder.columns:
+            self.drift = drift.DriftMonitor(profile, settings.DRIFT_WINDOW, settings.DRIFT_MIN_ROWS)
+        self.load_seconds = time.perf_counter() - started
+        self.loaded_at = time.time()
+
+    def per_tree_forest(self):
+        """The CompiledForest used for per-tree outputs, built on first use."""
+        if self._per_tree is None:
+            self._per_tree = CompiledForest.from_estimator(self.model)
+        return self._per_tree
+
+    def explainer(self):
+        """The TreeExplainer of this model, built on first use."""
+        if self._explainer is None:
+            self._explainer = TreeExplainer(self.per_tree_forest())
+        return self._explainer
+
+    def predict(self, X):
+        if self.compiled is self.model or (self.compiled is not None and len(X) <= settings.COMPILED_MAX_ROWS):
+            return self.compiled.predict(X)
+        return self.model.predict(X)
+
+    def warm_up(self):
+        X = self.encoder.transform(WARMUP_LISTINGS)
+        for row in range(len(X)):
+            self.predict(X[row:row + 1])
+        self.predict(X)
+        if settings.FORM_PRICE_RANGE:
+            self.per_tree_forest().predict_quantiles(X, settings.PRICE_QUANTILES)
+
+
+def _process_started():
+    """Wall-clock time this process was started (from /proc), else now."""
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+_started = _process_started()
+# seconds from process start to the end of each startup phase
+startup = OrderedDict()
+load_error = None
+_ready = threading.Event()
+
+
+def _mark(phase):
+    startup[phase] = round(time.time() - _started, 4)
+    metrics.STARTUP_SECONDS.labels(phase).set(startup[phase])
+
+
+def _activate(loaded):
+    global current
+    if current is not None:
+        metrics.MODEL_INFO.labels(current.version).set(0)
+    current = loaded
+    metrics.MODEL_LOAD_SECONDS.set(loaded.load_seconds)
+    metrics.MODEL_INFO.labels(loaded.version).set(loaded.loaded_at)
+
+
+current = None
+_reload_lock = threading.Lock()
+
+
+def load_initial():
+    """Load, warm up and activate the first model, then report ready."""
+    global load_error
+    with _reload_lock:
+        try:
+            loaded = LoadedModel(settings.MODEL_PATH)
+            _mark('model_loaded')
+            loaded.warm_up()
+            _mark('warmed_up')
+        except Exception as e:
+            load_error = str(e)
+            raise
+        _activate(loaded)
+    # only a prebuilt index: building one from the CSV pulls in pandas and
+    # scipy, so without CAR_COMPARABLES_INDEX the first lookup builds it
+    if settings.COMPARABLES_PRELOAD and settings.COMPARABLES_INDEX:
+        try:
+            comparables.get_index()
+            _mark('comparables_loaded')
+        except Exception:
+            # not needed to price a car; retried by the first comparables request
+            log.exception("building the comparables index failed")
+    _ready.set()
+    _mark('ready')
+    log.info("model %s ready %.3fs after process start", loaded.version, startup['ready'])
+    if startup['ready'] > settings.STARTUP_BUDGET:
+        log.warning("startup took %.3fs, over the %.3fs budget (phases: %s)", startup['ready'],
+                    settings.STARTUP_BUDGET, dict(startup))
+
+
+def _load_in_background():
+    try:
+        load_initial()
+    except Exception:
+        log.exception("loading %s failed; /ready stays unavailable", settings.MODEL_PATH)
+
+
+def wait_ready(timeout=None):
+    """Block until the first model is serving; False on timeout."""
+    return _ready.wait(timeout)
+
+
+def readiness():
+    return {
+        'ready': _ready.is_set(),
+        'model_version': current.version if current is not None else None,
+        'startup': dict(startup),
+        'budget': settings.STARTUP_BUDGET,
+        'error': load_error,
+    }
+
+
+_mark('imports')
+if settings.BACKGROUND_LOAD:
+    threading.Thread(target=_load_in_background, name='model-loader', daemon=True).start()
+else:
+    load_initial()
+
+
+def reload_model(force=False):
+    """Load, warm up and swap in the model at settings.MODEL_PATH.
+
+    Returns (LoadedModel, swapped).  On any failure the old model keeps
+    serving and the exception propagates.
+    """
+    with _reload_lock:
+        if current is None:
+            raise RuntimeError("the first model has not been loaded yet")
+        try:
+            candidate = LoadedModel(settings.MODEL_PATH)
+            if candidate.version == current.version and not force:
+                current.signature = candidate.signature
+                return current, False
+            candidate.warm_up()
+        except Exception:
+            metrics.MODEL_RELOADS.labels('failed').inc()
+            raise
+        previous = current
+        _activate(candidate)
+        metrics.MODEL_RELOADS.labels('swapped').inc()
+        log.info("model %s -> %s (loaded in %.3fs)", previous.version, candidate.version,
+                 candidate.load_seconds)
+        return candidate, True
+
+
+_watcher_pid = None
+
+
+def _watch(interval):
+    while True:
+        time.sleep(interval)
+        if current is None:
+            continue
+        signature = _file_signature(settings.MODEL_PATH)
+        if signature is None or signature == current.signature:
+            continue
+        # wait for the writer to finish before loading
+        time.sleep(interval)
+        if _file_signature(settings.MODEL_PATH) != signature:
+            continue
+        try:
+            reload_model()
+        except Exception:
+            log.exception("reloading %s failed; still serving %s", settings.MODEL_PATH, current.version)
+            current.signature = signature
+
+
+def ensure_watcher():
+    """Start the model file watcher in this process (again after a fork)."""
+    global _watcher_pid
+    if settings.RELOAD_INTERVAL <= 0 or _watcher_pid == os.getpid():
+        return
+    with _reload_lock:
+        if _watcher_pid != os.getpid():
+            thread = threading.Thread(target=_watch, args=(settings.RELOAD_INTERVAL,),
+                                      name='model-watcher', daemon=True)
+            thread.start()
+            _watcher_pid = os.getpid()
+
+
+def model_predict(X):
+    return current.predict(X)
+
+
+cache = None
+if settings.CACHE_SIZE > 0:
+    cache = PredictionCache(settings.CACHE_SIZE, ttl=settings.CACHE_TTL,
+                            price_step=settings.CACHE_PRICE_STEP,
+                            kms_step=settings.CACHE_KMS_STEP)
+
+
+batcher = None
+if settings.COALESCE:
+    batcher = MicroBatcher(model_predict, max_wait=settings.COALESCE_MAX_WAIT_MS / 1000.0,
+                           max_batch=settings.COALESCE_MAX_BATCH,
+                           on_batch=metrics.BATCH_SIZE.labels('coalesced').observe)
+
+
+def score(X, loaded=None):
+    loaded = loaded or current
+
+    def batched_predict(rows):
+        if batcher is not None and len(rows) < batcher.max_batch:
+            return batcher.predict(rows, loaded.predict)
+        return loaded.predict(rows)
+
+    if cache is not None:
+        return cache.predict(batched_predict, X, version=loaded.version, current=loaded is current)
+    return batched_predict(X)
+
+
+def score_range(X, quantiles, loaded=None):
+    """Return (mean, quantiles) of the per-tree predictions in one forest pass.
+
+    The spread of the trees is a rough price range, not a calibrated
+    prediction interval.  Bypasses the cache and the micro-batcher.
+    """
+    return (loaded or current).per_tree_forest().predict_quantiles(X, quantiles)
+
+
+def requested_quantiles(value):
+    """Parse a ``range`` query parameter: empty or 0 for none, 1 for the defaults."""
+    if value is None or value.lower() in ('', '0', 'false', 'no'):
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return settings.PRICE_QUANTILES
+    try:
+        quantiles = tuple(float(q) for q in value.split(',') if q)
+    except ValueError:
+        quantiles = ()
+    if not quantiles or not all(0 <= q <= 1 for q in quantiles):
+        raise ValueError("range must be 1 or comma-separated quantiles between 0 and 1")
+    return quantiles
+
+
+def _range_dict(quantiles, spread, row):
+    return dict(('p{:g}'.format(q * 100), round(float(spread[i, row]), 2)) for i, q in enumerate(quantiles))
+
+
+def explain(X, loaded=None):
+    """Return the (n_rows, n_columns) TreeSHAP contributions of ``X``.
+
+    Raises ValueError for more than CAR_EXPLAIN_MAX_ROWS rows or a model
+    without node covers.
+    """
+    loaded = loaded or current
+    if len(X) > settings.EXPLAIN_MAX_ROWS:
+        raise ValueError("at most {} listings can be explained per request".format(settings.EXPLAIN_MAX_ROWS))
+    explainer = loaded.explainer()
+    if loaded.explanations is not None:
+        return loaded.explanations.predict(explainer.shap_values, X)
+    return explainer.shap_values(X)
+
+
+def explain_result(contributions, loaded=None, single=False):
+    loaded = loaded or current
+    base_value = loaded.explainer().base_value
+    explanations = []
+    for row in contributions:
+        grouped = OrderedDict((field, 0.0) for field in loaded.encoder.fields)
+        for field, value in zip(loaded.encoder.fields, row):
+            grouped[field] += value
+        explanations.append({
+            'price': round(base_value + float(row.sum()), 2),
+            'base_value': round(base_value, 4),
+            'contributions': dict((field, round(float(value), 4)) for field, value in grouped.items()),
+        })
+    if single:
+        return dict(explanations[0], model_version=loaded.version)
+    return {'model_version': loaded.version, 'explanations': explanations}
+
+
+def refresh_metrics():
+    """Copy the cache counters and drift scores into their gauges before a scrape."""
+    if cache is not None:
+        for stat, value in cache.stats().items():
+            metrics.CACHE_EVENTS.labels(stat).set(value)
+    if current is not None and current.drift is not None:
+        for field, value in current.drift.scores().items():
+            if value is not None:
+                metrics.DRIFT_PSI.labels(field).set(value)
+
+
+def listings_from_payload(payload):
+    """Return the listings of a /predict/batch JSON body or raise ValueError."""
+    listings = payload.get('listings') if isinstance(payload, dict) else payload
+    if not isinstance(listings, list) or not listings:
+        raise ValueError("expected a non-empty JSON array of listings")
+    return listings
+
+
+def encode(listings, loaded=None):
+    """Encode listings, turning any bad field into ValueError("invalid listing: ...")."""
+    loaded = loaded or current
+    try:
+        X = loaded.encoder.transform(listings)
+    except KeyError as e:
+        raise ValueError("invalid listing: missing field {}".format(e))
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid listing: {}".format(e))
+    if loaded.drift is not None:
+        loaded.drift.update(X)
+    return X
+
+
+def explain_payload(payload):
+    """Return (listings, single) for an /explain body: one listing or a batch."""
+    if isinstance(payload, dict) and 'listings' not in payload:
+        return [listing_from_payload(payload)], True
+    return listings_from_payload(payload), False
+
+
+def listing_from_payload(payload):
+    """Return the listing of an /api/v1/predict JSON body or raise ValueError."""
+    if not isinstance(payload, dict) or not payload:
+        raise ValueError("expected a JSON object describing one listing")
+    return payload
+
+
+def api_result(prediction, loaded=None, quantiles=None, spread=None):
+    price = round(float(prediction[0]), 2)
+    result = {'price': price, 'can_sell': price >= 0, 'model_version': (loaded or current).version}
+    if quantiles:
+        result['range'] = _range_dict(quantiles, spread, 0)
+    return result
+
+
+def batch_result(prediction, loaded=None, quantiles=None, spread=None):
+    predictions = [{'price': round(float(p), 2), 'can_sell': bool(round(p, 2) >= 0)} for p in prediction]
+    if quantiles:
+        for row, item in enumerate(predictions):
+            item['range'] = _range_dict(quantiles, spread, row)
+    return {'model_version': (loaded or current).version, 'predictions': predictions}
+
+
+def price_curve_payload(payload):
+    """Return (listing, sweeps) of a /api/v1/price-curve body or raise ValueError.
+
+    Each sweep names a listing field and either explicit ``values`` or a
+    ``start``/``stop`` range of ``steps`` evenly spaced points.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("expected a JSON object with 'listing' and 'sweep'")
+    listing = listing_from_payload(payload.get('listing'))
+    sweeps = payload.get('sweep')
+    if isinstance(sweeps, dict):
+        sweeps = [sweeps]
+    if not isinstance(sweeps, list) or not 1 <= len(sweeps) <= 2:
+        raise ValueError("sweep must be one or two objects like {\"field\": \"Kms_Driven\", "
+                         "\"start\": 1000, \"stop\": 200000, \"steps\": 50}")
+    parsed = []
+    for sweep in sweeps:
+        if not isinstance(sweep, dict) or sweep.get('field') not in NUMERIC_FIELDS + CATEGORICAL_FIELDS:
+            raise ValueError("sweep field must be one of {}".format(', '.join(NUMERIC_FIELDS + CATEGORICAL_FIELDS)))
+        field = sweep['field']
+        if field in (name for name, _ in parsed):
+            raise ValueError("{} is swept twice".format(field))
+        if 'values' in sweep:
+            values = sweep['values']
+            if not isinstance(values, list) or not values:
+                raise ValueError("values of {} must be a non-empty list".format(field))
+            if len(values) > settings.PRICE_CURVE_MAX_POINTS:
+                raise ValueError("at most {} points per curve".format(settings.PRICE_CURVE_MAX_POINTS))
+        elif field in CATEGORICAL_FIELDS:
+            values = None  # every category the model knows
+        else:
+            try:
+                start, stop = float(sweep['start']), float(sweep['stop'])
+                steps = int(sweep.get('steps', settings.PRICE_CURVE_STEPS))
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("sweep of {} needs numeric start and stop (or values)".format(field))
+            if steps < 2:
+                raise ValueError("steps of {} must be at least 2".format(field))
+            if steps > settings.PRICE_CURVE_MAX_POINTS:
+                raise ValueError("at most {} points per curve".format(settings.PRICE_CURVE_MAX_POINTS))
+            values = np.linspace(start, stop, steps).tolist()
+        parsed.append((field, values))
+    return listing, parsed
+
+
+def price_curve_grid(listing, sweeps, loaded=None):
+    """Encode the grid of ``sweeps`` around ``listing`` as one matrix.
+
+    Returns (X, axes) with one row per grid point, the last sweep varying
+    fastest, and axes as [(field, values)].  Each axis is encoded once and
+    the grid is assembled by repeating and tiling the encoded columns.
+    """
+    loaded = loaded or current
+    sweeps = [(field, list(loaded.encoder.categories[field]) if values is None else values)
+              for field, values in sweeps]
+    # a swept field the listing leaves out starts at its first sweep value
+    listing = dict(listing)
+    for field, values in sweeps:
+        listing.setdefault(field, values[0])
+    try:
+        base = loaded.encoder.transform(listing)
+    except KeyError as e:
+        raise ValueError("invalid listing: missing field {}".format(e))
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid listing: {}".format(e))
+    axes = []
+    blocks = []
+    for field, values in sweeps:
+        try:
+            block = loaded.encoder.transform([dict(listing, **{field: value}) for value in values])
+        except KeyError as e:
+            raise ValueError("invalid listing: missing field {}".format(e))
+        except (TypeError, ValueError) as e:
+            raise ValueError("invalid sweep of {}: {}".format(field, e))
+        axes.append((field, values))
+        blocks.append(block)
+    size = int(np.prod([len(values) for _, values in axes]))
+    if size > settings.PRICE_CURVE_MAX_POINTS:
+        raise ValueError("the grid has {} points; at most {} are allowed".format(size, settings.PRICE_CURVE_MAX_POINTS))
+    X = blocks[0]
+    if len(blocks) == 2:
+        columns = [j for j, name in enumerate(loaded.encoder.fields) if name == axes[1][0]]
+        X = np.repeat(X, len(blocks[1]), axis=0)
+        X[:, columns] = np.tile(blocks[1][:, columns], (len(blocks[0]), 1))
+    if loaded.drift is not None:
+        # only the base listing is traffic, not every grid point
+        loaded.drift.update(base)
+    return X, axes
+
+
+def score_grid(X, quantiles=None, loaded=None):
+    """Score a price-curve grid with a single model call: (prediction, spread).
+
+    Bypasses the cache and the micro-batcher, which would only split or
+    store the grid row by row.
+    """
+    loaded = loaded or current
+    if quantiles:
+        return loaded.per_tree_forest().predict_quantiles(X, quantiles)
+    return loaded.predict(X), None
+
+
+def price_curve_result(prediction, axes, loaded=None, quantiles=None, spread=None):
+    shape = [len(values) for _, values in axes]
+    result = {
+        'model_version': (loaded or current).version,
+        'sweep': [{'field': field, 'values': values} for field, values in axes],
+        'prices': np.round(prediction, 2).reshape(shape).tolist(),
+    }
+    if quantiles:
+        result['range'] = dict(('p{:g}'.format(q * 100), np.round(spread[i], 2).reshape(shape).tolist())
+                               for i, q in enumerate(quantiles))
+    return result
+
+
+def drift_report(loaded=None):
+    loaded = loaded or current
+    if loaded is None:
+        # admin routes are served while the first model loads
+        return {'model_version': None, 'enabled': False, 'loading': True}
+    if loaded.drift is None:
+        return {'model_version': loaded.version, 'enabled': False,
+                'reason': "no drift profile ({})".format(drift.drift_path_for(loaded.path))}
+    return dict(loaded.drift.report(), model_version=loaded.version, enabled=True)
+
+
+def model_status():
+    if current is None:
+        return {'version': None, 'path': settings.MODEL_PATH, 'loading': load_error is None, 'error': load_error}
+    return {
+        'version': current.version,
+        'path': current.path,
+        'loaded_at': current.loaded_at,
+        'load_seconds': round(current.load_seconds, 4),
+        'engine': 'compiled' if current.compiled is not None else 'sklearn',
+    }
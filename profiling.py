@@ -0,0 +1,149 @@
+"""Sampling profiler for live prediction requests.
+
+A fraction of requests (CAR_PROFILE_RATE, changeable at runtime through
+/admin/profile) plus any request sent with ``X-Profile: 1`` and a valid
+admin token are profiled.  While such a request runs, its thread is
+registered with the profiler and a background thread samples its stack
+through ``sys._current_frames()`` every CAR_PROFILE_INTERVAL_MS.  Samples
+are aggregated in memory as collapsed stacks (``root;...;leaf count``), the
+input format of flamegraph.pl, speedscope and inferno.
+
+Requests that are not profiled pay one random draw; the sampler sleeps
+whenever no profiled request is running.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import settings
+
+
+def _short_path(filename, _cache={}):
+    short = _cache.get(filename)
+    if short is None:
+        short = filename
+        for prefix in sorted((p for p in sys.path if p), key=len, reverse=True):
+            if filename.startswith(prefix + os.sep):
+                short = filename[len(prefix) + 1:]
+                break
+        _cache[filename] = short
+    return short
+
+
+def collapse(frame):
+    """Return the collapsed root-to-leaf stack of ``frame``."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, _short_path(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, rate=0.0, interval=0.002, max_stacks=10000):
+        self.rate = rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.samples = self.dropped = self.requests = 0
+        self._active = Counter()
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def should_profile(self, forced=False):
+        return forced or (self.rate > 0 and random.random() < self.rate)
+
+    def _ensure_running(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='sampling-profiler', daemon=True).start()
+
+    def start(self):
+        """Profile the calling thread until ``stop`` is called with the returned id."""
+        ident = threading.get_ident()
+        with self._cond:
+            self._ensure_running()
+            self._active[ident] += 1
+            self.requests += 1
+            self._cond.notify()
+        return ident
+
+    def stop(self, ident):
+        with self._cond:
+            self._active[ident] -= 1
+            if self._active[ident] <= 0:
+                del self._active[ident]
+
+    @contextmanager
+    def track(self):
+        ident = self.start()
+        try:
+            yield
+        finally:
+            self.stop(ident)
+
+    def wrap(self, fn):
+        """Return ``fn`` profiled on whatever thread ends up calling it."""
+        def profiled(*args, **kwargs):
+            with self.track():
+                return fn(*args, **kwargs)
+        return profiled
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                idents = list(self._active)
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            stacks = [collapse(frames[ident]) for ident in idents if ident in frames]
+            del frames
+            with self._cond:
+                for stack in stacks:
+                    if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                        self.stacks[stack] += 1
+                    else:
+                        self.dropped += 1
+                self.samples += len(stacks)
+
+    def collapsed(self):
+        """The aggregated samples, one ``stack count`` line per distinct stack."""
+        with self._cond:
+            items = sorted(self.stacks.items())
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in items)
+
+    def reset(self):
+        with self._cond:
+            self.stacks.clear()
+            self.samples = self.dropped = self.requests = 0
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'interval_ms': self.interval * 1000,
+                'requests': self.requests,
+                'samples': self.samples,
+                'stacks': len(self.stacks),
+                'dropped': self.dropped,
+                'active': sum(self._active.values()),
+            }
+
+
+profiler = SamplingProfiler(settings.PROFILE_RATE, settings.PROFILE_INTERVAL_MS / 1000.0,
+                            settings.PROFILE_MAX_STACKS)
+
+
+def parse_rate(value):
+    """Parse a sampling fraction in [0, 1] or raise ValueError."""
+    rate = float(value)
+    if not 0 <= rate <= 1:
+        raise ValueError("rate must be between 0 and 1")
+    return rate
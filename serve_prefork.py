@@ -0,0 +1,170 @@
+"""Pre-fork production launcher for app.py.
+
+The master process imports ``app`` (which loads the model), runs a full
+collection and moves every surviving object into the GC's permanent
+generation with ``gc.freeze()``.  Frozen objects are never scanned again,
+so the collector in the forked workers does not write to the pages holding
+the model and they stay shared copy-on-write.  The master then binds one
+listening socket and forks workers that all accept on it, restarting any
+worker that dies.
+
+    python serve_prefork.py --workers 4 --port 5000
+
+Startup time and resident/proportional memory of the master and of each
+worker are logged; PSS is the fair share of shared pages, so the sum over
+workers shows how much of the model is really duplicated.
+
+Each worker holds its own copy of the serving model: ``/admin/reload``
+swaps it only in the worker that handled the request.  Set
+CAR_RELOAD_INTERVAL so the file watcher in every worker reloads a new
+model file.
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import settings
+
+log = logging.getLogger('prefork')
+
+
+def memory_usage(pid='self'):
+    """Return {'rss': bytes, 'pss': bytes or None, 'shared': bytes or None}."""
+    usage = {'rss': None, 'pss': None, 'shared': None}
+    fields = {'Rss:': 'rss', 'Pss:': 'pss', 'Shared_Clean:': 'shared', 'Shared_Dirty:': 'shared'}
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                parts = line.split()
+                key = fields.get(parts[0])
+                if key:
+                    usage[key] = (usage[key] or 0) + int(parts[1]) * 1024
+        return usage
+    except (IOError, OSError):
+        pass
+    if pid == 'self':
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['rss'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    return usage
+
+
+def _format_memory(usage):
+    return ', '.join('{}={:.1f}MB'.format(key, value / 1048576.0)
+                     for key, value in sorted(usage.items()) if value is not None)
+
+
+def _bind(host, port, backlog):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(index, sock, wsgi_app, threaded):
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # the frozen objects stay out of the collector's reach
+    gc.enable()
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, wsgi_app, threaded=threaded, fd=sock.fileno())
+    log.info("worker %d (pid %d) ready: %s", index, os.getpid(), _format_memory(memory_usage()))
+    server.serve_forever()
+
+
+def _spawn(index, sock, wsgi_app, threaded):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _run_worker(index, sock, wsgi_app, threaded)
+        except BaseException:
+            log.exception("worker %d crashed", index)
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve(host, port, workers, threaded=False, backlog=2048, report_interval=60):
+    started = time.perf_counter()
+    gc.disable()
+    import app as service
+    # with CAR_BACKGROUND_LOAD the master still waits, so workers fork with the model
+    while not service.predictor.wait_ready(0.5):
+        if service.predictor.load_error is not None:
+            sys.exit("loading {} failed: {}".format(settings.MODEL_PATH, service.predictor.load_error))
+    loaded = time.perf_counter()
+    gc.collect()
+    gc.freeze()
+    log.info("model %s loaded in %.3fs; %d objects frozen; master: %s",
+             settings.MODEL_PATH, loaded - started, gc.get_freeze_count(),
+             _format_memory(memory_usage()))
+
+    sock = _bind(host, port, backlog)
+    children = {}
+    for index in range(workers):
+        children[_spawn(index, sock, service.app, threaded)] = index
+    log.info("listening on %s:%d with %d workers (startup %.3fs)",
+             host, port, workers, time.perf_counter() - started)
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    next_report = time.monotonic() + report_interval
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            if report_interval and time.monotonic() >= next_report and not stopping:
+                for child, index in sorted(children.items(), key=lambda item: item[1]):
+                    log.info("worker %d (pid %d): %s", index, child, _format_memory(memory_usage(child)))
+                next_report = time.monotonic() + report_interval
+            time.sleep(0.2)
+            continue
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        log.warning("worker %d (pid %d) exited with status %d, restarting", index, pid, status)
+        children[_spawn(index, sock, service.app, threaded)] = index
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default=settings.HOST)
+    parser.add_argument('--port', type=int, default=settings.PORT)
+    parser.add_argument('--workers', type=int, default=settings.WORKERS)
+    parser.add_argument('--threaded', action='store_true',
+                        help="serve each worker's requests on threads")
+    parser.add_argument('--report-interval', type=float, default=60,
+                        help="seconds between worker memory reports, 0 to disable")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(message)s')
+    serve(args.host, args.port, max(1, args.workers), threaded=args.threaded,
+          report_interval=args.report_interval)
+
+
+if __name__ == "__main__":
+    main()
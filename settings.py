@@ -0,0 +1,101 @@
+"""Runtime settings for the prediction service, read from CAR_* environment variables."""
+import os
+
+
+def _env(name, default, cast=str):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    if cast is bool:
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return cast(value)
+
+
+MODEL_PATH = _env('CAR_MODEL_PATH', 'random_forest_regression_model.pkl')
+# seconds between checks of MODEL_PATH for a new model; 0 disables the watcher
+RELOAD_INTERVAL = _env('CAR_RELOAD_INTERVAL', 0.0, float)
+# load and warm up the first model on a background thread, so the server
+# accepts connections (and /ready answers 503) while it loads
+BACKGROUND_LOAD = _env('CAR_BACKGROUND_LOAD', False, bool)
+# seconds from process start to ready; a slower start logs a warning
+STARTUP_BUDGET = _env('CAR_STARTUP_BUDGET', 2.0, float)
+# required in X-Admin-Token by the /admin routes; they are disabled when empty
+ADMIN_TOKEN = _env('CAR_ADMIN_TOKEN', '')
+
+# 'sklearn' calls model.predict directly, 'compiled' uses forest_engine.CompiledForest
+INFERENCE_ENGINE = _env('CAR_INFERENCE_ENGINE', 'sklearn')
+
+# batches larger than this go to sklearn even with the compiled engine;
+# sklearn's per-call overhead is amortised and its Cython loop wins there
+COMPILED_MAX_ROWS = _env('CAR_COMPILED_MAX_ROWS', 512, int)
+
+# quantiles of the per-tree predictions reported as a price range
+PRICE_QUANTILES = _env('CAR_PRICE_QUANTILES', (0.1, 0.9),
+                       lambda value: tuple(float(q) for q in value.split(',') if q))
+# show that range on the HTML form; opt-in, as it bypasses the cache and batcher
+FORM_PRICE_RANGE = _env('CAR_FORM_PRICE_RANGE', False, bool)
+
+# /explain: rows per request (about 15 ms each on the 900-tree model, less
+# on a compressed one) and the per-model explanation cache size
+EXPLAIN_MAX_ROWS = _env('CAR_EXPLAIN_MAX_ROWS', 20, int)
+EXPLAIN_CACHE_SIZE = _env('CAR_EXPLAIN_CACHE_SIZE', 2000, int)
+
+# feature drift monitor (drift.py), active for models with a .drift.json
+# profile: live histograms are halved every DRIFT_WINDOW rows and scored
+# once they hold DRIFT_MIN_ROWS
+DRIFT_MONITOR = _env('CAR_DRIFT_MONITOR', True, bool)
+DRIFT_WINDOW = _env('CAR_DRIFT_WINDOW', 10000, int)
+DRIFT_MIN_ROWS = _env('CAR_DRIFT_MIN_ROWS', 100, int)
+
+# comparable listings (comparables.py): KD-tree over CAR_COMPARABLES_DATA,
+# or a prebuilt index file; a prebuilt file is loaded before /ready unless
+# PRELOAD is off, the CSV is indexed on the first lookup
+COMPARABLES_DATA = _env('CAR_COMPARABLES_DATA', 'car data.csv')
+COMPARABLES_INDEX = _env('CAR_COMPARABLES_INDEX', '')
+COMPARABLES_PRELOAD = _env('CAR_COMPARABLES_PRELOAD', True, bool)
+# distance added by a different fuel type or transmission
+COMPARABLES_CATEGORY_WEIGHT = _env('CAR_COMPARABLES_CATEGORY_WEIGHT', 1.0, float)
+COMPARABLES_K = _env('CAR_COMPARABLES_K', 5, int)
+COMPARABLES_MAX_K = _env('CAR_COMPARABLES_MAX_K', 50, int)
+
+# /api/v1/price-curve: default points of a start/stop sweep and the cap on
+# grid points (one or two sweeps) scored in its single model call
+PRICE_CURVE_STEPS = _env('CAR_PRICE_CURVE_STEPS', 20, int)
+PRICE_CURVE_MAX_POINTS = _env('CAR_PRICE_CURVE_MAX_POINTS', 2500, int)
+
+# sampling profiler (profiling.py): fraction of requests profiled, also
+# settable at runtime via /admin/profile, and the stack sampling interval
+PROFILE_RATE = _env('CAR_PROFILE_RATE', 0.0, float)
+PROFILE_INTERVAL_MS = _env('CAR_PROFILE_INTERVAL_MS', 2.0, float)
+PROFILE_MAX_STACKS = _env('CAR_PROFILE_MAX_STACKS', 10000, int)
+
+# shadow evaluation (shadow.py) of a candidate model on a fraction of live
+# requests, after the response; CAR_SHADOW_MODEL_PATH empty disables it
+SHADOW_MODEL_PATH = _env('CAR_SHADOW_MODEL_PATH', '')
+SHADOW_RATE = _env('CAR_SHADOW_RATE', 1.0, float)
+SHADOW_THREADS = _env('CAR_SHADOW_THREADS', 1, int)
+# requests waiting for the shadow threads; more are dropped, never waited for
+SHADOW_QUEUE_SIZE = _env('CAR_SHADOW_QUEUE_SIZE', 1000, int)
+SHADOW_LOG = _env('CAR_SHADOW_LOG', 'shadow.jsonl')
+SHADOW_FLUSH_ROWS = _env('CAR_SHADOW_FLUSH_ROWS', 256, int)
+SHADOW_FLUSH_SECONDS = _env('CAR_SHADOW_FLUSH_SECONDS', 1.0, float)
+
+HOST = _env('CAR_HOST', '127.0.0.1')
+PORT = _env('CAR_PORT', 5000, int)
+WORKERS = _env('CAR_WORKERS', os.cpu_count() or 1, int)
+
+# prediction cache; CAR_CACHE_SIZE=0 disables it
+CACHE_SIZE = _env('CAR_CACHE_SIZE', 10000, int)
+CACHE_TTL = _env('CAR_CACHE_TTL', 3600.0, float)
+# quantization steps for the cache key; 0 means exact match
+CACHE_PRICE_STEP = _env('CAR_CACHE_PRICE_STEP', 0.0, float)
+CACHE_KMS_STEP = _env('CAR_CACHE_KMS_STEP', 0, int)
+
+# micro-batching of concurrent single-row requests (coalescer.MicroBatcher)
+COALESCE = _env('CAR_COALESCE', False, bool)
+COALESCE_MAX_WAIT_MS = _env('CAR_COALESCE_MAX_WAIT_MS', 2.0, float)
+COALESCE_MAX_BATCH = _env('CAR_COALESCE_MAX_BATCH', 64, int)
+
+# asgi.py: scoring thread pool size and the cap on requests waiting for it
+ASGI_THREADS = _env('CAR_ASGI_THREADS', os.cpu_count() or 1, int)
+ASGI_MAX_PENDING = _env('CAR_ASGI_MAX_PENDING', 256, int)
@@ -0,0 +1,205 @@
+"""Shadow evaluation of a candidate model on live traffic.
+
+With CAR_SHADOW_MODEL_PATH set, the listings of (a CAR_SHADOW_RATE fraction
+of) prediction requests are queued together with the serving model's
+prediction once the response has been sent.  A small pool of background
+threads loads the candidate on first use, encodes and scores the listings
+with it and appends one JSON line per request to CAR_SHADOW_LOG::
+
+    {"ts": ..., "route": "predict_batch", "primary_version": "...",
+     "candidate_version": "...", "primary": [...], "candidate": [...],
+     "delta": [...]}
+
+The request path only does a non-blocking ``put`` on a bounded queue: when
+the queue is full the item is dropped and counted, so a slow or broken
+candidate can never add latency to the serving model.  Lines are buffered
+and written in batches of CAR_SHADOW_FLUSH_ROWS, or after
+CAR_SHADOW_FLUSH_SECONDS of quiet.  The threads are started lazily and
+again after a fork, like the micro-batcher's.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+
+import fastjson
+import metrics
+import settings
+
+log = logging.getLogger(__name__)
+
+
+class JsonlSink(object):
+    """Buffered, append-only JSON-lines file shared by the shadow threads."""
+
+    def __init__(self, path, flush_rows=256, flush_seconds=1.0):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self.written = 0
+
+    def write(self, record):
+        with self._lock:
+            self._buffer.append(fastjson.dumps(record) + b'\n')
+            if len(self._buffer) >= self.flush_rows:
+                self._flush()
+
+    def flush_if_due(self):
+        with self._lock:
+            if self._buffer and time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            with open(self.path, 'ab') as f:
+                f.write(b''.join(lines))
+        except (IOError, OSError):
+            log.exception("writing %d shadow records to %s failed", len(lines), self.path)
+            metrics.SHADOW_EVENTS.labels('write_failed').inc(len(lines))
+            return
+        self.written += len(lines)
+
+
+class ShadowEvaluator(object):
+
+    def __init__(self, candidate_path, sink, threads=1, queue_size=1000, rate=1.0):
+        self.candidate_path = candidate_path
+        self.sink = sink
+        self.threads = threads
+        self.queue_size = queue_size
+        self.rate = rate
+        self.candidate = None
+        self.load_error = None
+        self._load_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.submitted = self.dropped = self.scored = self.failed = 0
+
+    def _ensure_running(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.queue_size)
+                for i in range(self.threads):
+                    threading.Thread(target=self._run, args=(self._queue,),
+                                     name='shadow-{}'.format(i), daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, route, listings, prediction, primary_version):
+        """Queue one request for the candidate; never blocks, drops when full."""
+        if self.rate < 1 and random.random() >= self.rate:
+            return False
+        self._ensure_running()
+        try:
+            self._queue.put_nowait((time.time(), route, listings, prediction, primary_version))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            metrics.SHADOW_EVENTS.labels('dropped').inc()
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _load(self):
+        with self._load_lock:
+            if self.candidate is None:
+                # a candidate that failed to load is not retried for every request
+                if self.load_error is not None:
+                    raise RuntimeError("shadow model failed to load: {}".format(self.load_error))
+                import predictor
+                try:
+                    candidate = predictor.LoadedModel(self.candidate_path)
+                    candidate.warm_up()
+                except Exception as e:
+                    self.load_error = str(e)
+                    raise
+                self.candidate = candidate
+                log.info("shadow model %s loaded from %s", candidate.version, self.candidate_path)
+        return self.candidate
+
+    def _run(self, pending):
+        while True:
+            try:
+                item = pending.get(timeout=self.sink.flush_seconds)
+            except queue.Empty:
+                self.sink.flush_if_due()
+                continue
+            try:
+                self._evaluate(*item)
+            except Exception:
+                log.exception("shadow evaluation failed")
+                with self._lock:
+                    self.failed += 1
+                metrics.SHADOW_EVENTS.labels('failed').inc()
+            self.sink.flush_if_due()
+
+    def _evaluate(self, ts, route, listings, prediction, primary_version):
+        candidate = self._load()
+        if isinstance(listings, dict):
+            listings = [listings]
+        X = candidate.encoder.transform(listings)
+        primary = np.asarray(prediction, dtype=np.float64)
+        scored = candidate.predict(X)
+        delta = scored - primary
+        for value in np.abs(delta):
+            metrics.SHADOW_ABS_DELTA.observe(value)
+        self.sink.write({
+            'ts': ts,
+            'route': route,
+            'primary_version': primary_version,
+            'candidate_version': candidate.version,
+            'primary': np.round(primary, 4).tolist(),
+            'candidate': np.round(scored, 4).tolist(),
+            'delta': np.round(delta, 4).tolist(),
+        })
+        with self._lock:
+            self.scored += 1
+        metrics.SHADOW_EVENTS.labels('scored').inc()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'candidate_path': self.candidate_path,
+                'candidate_version': self.candidate.version if self.candidate is not None else None,
+                'load_error': self.load_error,
+                'submitted': self.submitted,
+                'scored': self.scored,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'queued': self._queue.qsize() if self._queue is not None else 0,
+                'written': self.sink.written,
+            }
+
+
+evaluator = None
+if settings.SHADOW_MODEL_PATH:
+    evaluator = ShadowEvaluator(
+        settings.SHADOW_MODEL_PATH,
+        JsonlSink(settings.SHADOW_LOG, settings.SHADOW_FLUSH_ROWS, settings.SHADOW_FLUSH_SECONDS),
+        threads=settings.SHADOW_THREADS, queue_size=settings.SHADOW_QUEUE_SIZE, rate=settings.SHADOW_RATE)
+    atexit.register(evaluator.sink.flush)
+
+
+def submit(route, listings, prediction, loaded):
+    """Mirror a served request to the candidate model, if one is configured."""
+    if evaluator is not None:
+        evaluator.submit(route, listings, prediction, loaded.version)
@@ -0,0 +1,40 @@
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+def test_model_swap_while_scoring_returns_predictions_without_caching():
+    cache = PredictionCache(maxsize=10)
+    X = np.array([[5.59, np.log(27000), 0, 6, 0, 1, 0, 1]])
+
+    def predict_a(rows):
+        # a hot reload to version 'b' lands while version 'a' is scoring
+        cache.predict(lambda inner: np.full(len(inner), 2.0), X + 1, version='b')
+        return np.full(len(rows), 1.0)
+
+    assert cache.predict(predict_a, X, version='a').tolist() == [1.0]
+    # only the 'b' prediction was stored; the stale 'a' one was not
+    assert cache.stats()['size'] == 1
+    assert cache.predict(lambda rows: np.full(len(rows), 3.0), X, version='b').tolist() == [3.0]
+
+
+def test_rollback_to_an_earlier_model_version_uses_the_cache_again():
+    cache = PredictionCache(maxsize=10)
+    X = np.array([[5.59, np.log(27000), 0, 6, 0, 1, 0, 1]])
+    calls = []
+
+    def predict(rows):
+        calls.append(len(rows))
+        return np.full(len(rows), 1.0)
+
+    # /admin/reload A -> B -> A: the rolled-back file has A's hash again
+    for version in ('a', 'b', 'a'):
+        cache.predict(predict, X, version=version)
+    assert cache.predict(predict, X, version='a').tolist() == [1.0]
+    assert len(calls) == 3
+    assert cache.stats()['hits'] == 1
+    # a request still pinned to B bypasses the cache without clearing it
+    assert cache.predict(predict, X + 1, version='b', current=False).tolist() == [1.0]
+    assert cache.stats()['size'] == 1
+    assert cache.predict(predict, X, version='a').tolist() == [1.0]
+    assert cache.stats()['hits'] == 2